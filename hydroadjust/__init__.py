@@ -5,9 +5,7 @@ This package provides tools to burn hydrological adjustment objects into DEM ras
 ensuring that water can flow uninterrupted through culverts, under bridges, etc.
 """
 
-from .workflow import HydroAdjustWorkflow, create_hydro_adjusted_dtm
-from .burning import burn_lines
-from .sampling import BoundingBox, get_raster_window, get_raster_interpolator
+import importlib
 
 __version__ = "1.0.0"
 __author__ = "Danish Agency for Data Supply and Efficiency (SDFE)"
@@ -19,4 +17,28 @@ __all__ = [
     "BoundingBox",
     "get_raster_window",
     "get_raster_interpolator"
-]
\ No newline at end of file
+]
+
+# The public names are imported from their submodules on first access (PEP
+# 562), so that importing the package does not load GDAL, GeoPandas etc.
+_LAZY = {
+    "HydroAdjustWorkflow": "workflow",
+    "create_hydro_adjusted_dtm": "workflow",
+    "burn_lines": "burning",
+    "BoundingBox": "sampling",
+    "get_raster_window": "sampling",
+    "get_raster_interpolator": "sampling",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        module = importlib.import_module(f".{_LAZY[name]}", __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
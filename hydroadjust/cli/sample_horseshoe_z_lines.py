@@ -1,10 +1,11 @@
-from hydroadjust.sampling import BoundingBox, get_raster_window, get_raster_interpolator
+from hydroadjust.sampling import BoundingBox, TileCache, sample_raster_array
 
 from osgeo import gdal, ogr
 import numpy as np
 from tqdm import tqdm
 import argparse
 import logging
+import math
 
 gdal.UseExceptions()
 ogr.UseExceptions()
@@ -31,6 +32,11 @@ def main():
     output_lines_path = input_arguments.output_lines
 
     input_raster_dataset = gdal.Open(input_raster_path)
+
+    # Decoded raster blocks are cached, as neighboring objects often need
+    # windows from the same blocks
+    input_raster_tile_cache = TileCache(input_raster_dataset)
+
     input_raster_geotransform = input_raster_dataset.GetGeoTransform()
 
     if input_arguments.max_sample_dist is None:
@@ -52,6 +58,7 @@ def main():
         "rendered_horseshoe_lines",
         srs=input_horseshoes_layer.GetSpatialRef(),
         geom_type=ogr.wkbLineString25D,
+        options=['SPATIAL_INDEX=NO'],
     )
     output_lines_layer = output_lines_datasrc.GetLayer()
 
@@ -61,82 +68,118 @@ def main():
     valid_profile_count = 0
     invalid_profile_count = 0
 
-    for horseshoe_feature in tqdm(input_horseshoes_layer, ascii=True, unit="obj"):
-        horseshoe_geometry = horseshoe_feature.GetGeometryRef()
+    # Scratch buffers for the profile sampling, reused across horseshoes to
+    # avoid allocating new arrays for every object
+    sample_index_buffer = np.empty(0)
+    profile_abscissa_buffer = np.empty(0)
+    open_profile_xy_buffer = np.empty((0, 2))
+    closed_profile_xy_buffer = np.empty((0, 2))
+
+    # All features are written in a single transaction, as committing every
+    # feature separately is very slow with GeoPackage
+    output_lines_layer.StartTransaction()
+    try:
+        for horseshoe_feature in tqdm(input_horseshoes_layer, ascii=True, unit="obj"):
+            horseshoe_geometry = horseshoe_feature.GetGeometryRef()
         
-        # Rule out non-horseshoe geometries (apparently calling .GetGeomType() on
-        # the layer yields weird results)
-        if not (horseshoe_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
-            raise ValueError("encountered unexpected geometry type")
+            # Rule out non-horseshoe geometries (apparently calling .GetGeomType() on
+            # the layer yields weird results)
+            if not (horseshoe_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
+                raise ValueError("encountered unexpected geometry type")
         
-        if horseshoe_geometry.GetPointCount() == 4:
-            # We want to consider only the X and Y of the geometry
-            horseshoe_xy = np.array(horseshoe_geometry.GetPoints())[:,:2]
-
-            horseshoe_bbox = BoundingBox(
-                x_min=np.min(horseshoe_xy[:,0]),
-                x_max=np.max(horseshoe_xy[:,0]),
-                y_min=np.min(horseshoe_xy[:,1]),
-                y_max=np.max(horseshoe_xy[:,1]),
-            )
-
-            # Get a raster window just covering this horseshoe
-            window_raster_dataset = get_raster_window(input_raster_dataset, horseshoe_bbox)
-
-            window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
-
-            # Length of (open) AD segment
-            open_profile_length = np.hypot(
-                horseshoe_xy[3, 0] - horseshoe_xy[0, 0],
-                horseshoe_xy[3, 1] - horseshoe_xy[0, 1],
-            )
-            # Length of (closed) BC segment
-            closed_profile_length = np.hypot(
-                horseshoe_xy[2, 0] - horseshoe_xy[1, 0],
-                horseshoe_xy[2, 1] - horseshoe_xy[1, 1],
-            )
-
-            # Determine number of samples to take along the profiles (at least 2)
-            longest_profile_length = max(open_profile_length, closed_profile_length)
-            num_profile_samples = max(2, int(np.ceil(longest_profile_length / max_profile_sample_dist)) + 1)
-
-            # Along-profile coordinates
-            profile_abscissa = np.linspace(
-                0.0,
-                1.0,
-                num_profile_samples,
-                endpoint=True,
-            )
-
-            # Interpolate (X, Y) along the two profiles
-            open_profile_xy = horseshoe_xy[0,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[3,:] - horseshoe_xy[0,:])
-            closed_profile_xy = horseshoe_xy[1,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[2,:] - horseshoe_xy[1,:])
-
-            # Sample the raster Z in those interpolated (X, Y) locations
-            open_profile_z = window_raster_interpolator((open_profile_xy[:,0], open_profile_xy[:,1]))
-            closed_profile_z = window_raster_interpolator((closed_profile_xy[:,0], closed_profile_xy[:,1]))
-
-            # Render only if there is no NaN in the profiles
-            if np.all(np.isfinite(open_profile_z)) and np.all(np.isfinite(closed_profile_z)):
-                # Create line features
-                for i in range(num_profile_samples):
-                    line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
-                    line_geometry = ogr.Geometry(ogr.wkbLineString25D)
-                    line_geometry.AddPoint(open_profile_xy[i,0], open_profile_xy[i,1], open_profile_z[i])
-                    line_geometry.AddPoint(closed_profile_xy[i,0], closed_profile_xy[i,1], closed_profile_z[i])
-                    line_feature.SetGeometry(line_geometry)
-                    output_lines_layer.CreateFeature(line_feature)
-                    line_feature = None
-
-                valid_profile_count += 1
+            if horseshoe_geometry.GetPointCount() == 4:
+                # We want to consider only the X and Y of the geometry
+                horseshoe_xy = np.array(horseshoe_geometry.GetPoints())[:,:2]
+
+                horseshoe_bbox = BoundingBox(
+                    x_min=np.min(horseshoe_xy[:,0]),
+                    x_max=np.max(horseshoe_xy[:,0]),
+                    y_min=np.min(horseshoe_xy[:,1]),
+                    y_max=np.max(horseshoe_xy[:,1]),
+                )
+
+                # Get a raster window just covering this horseshoe
+                window_raster_grid, window_raster_geotransform = input_raster_tile_cache.get_window(horseshoe_bbox)
+
+                # The profile lengths are computed on plain floats, which is much
+                # faster than NumPy calls for single values
+                (a_x, a_y), (b_x, b_y), (c_x, c_y), (d_x, d_y) = horseshoe_xy.tolist()
+
+                # Length of (open) AD segment
+                open_profile_length = math.hypot(d_x - a_x, d_y - a_y)
+                # Length of (closed) BC segment
+                closed_profile_length = math.hypot(c_x - b_x, c_y - b_y)
+
+                # Determine number of samples to take along the profiles (at least 2)
+                longest_profile_length = max(open_profile_length, closed_profile_length)
+                num_profile_samples = max(2, math.ceil(longest_profile_length / max_profile_sample_dist) + 1)
+
+                # Grow the scratch buffers if this horseshoe needs more samples
+                # than any previous one
+                if num_profile_samples > len(profile_abscissa_buffer):
+                    buffer_size = max(num_profile_samples, 2*len(profile_abscissa_buffer))
+                    sample_index_buffer = np.arange(buffer_size, dtype=float)
+                    profile_abscissa_buffer = np.empty(buffer_size)
+                    open_profile_xy_buffer = np.empty((buffer_size, 2))
+                    closed_profile_xy_buffer = np.empty((buffer_size, 2))
+
+                # Along-profile coordinates (equivalent to np.linspace(0, 1, n))
+                profile_abscissa = profile_abscissa_buffer[:num_profile_samples]
+                np.divide(sample_index_buffer[:num_profile_samples], num_profile_samples - 1, out=profile_abscissa)
+
+                # Interpolate (X, Y) along the two profiles
+                open_profile_xy = open_profile_xy_buffer[:num_profile_samples]
+                np.multiply(profile_abscissa[:,np.newaxis], horseshoe_xy[3,:] - horseshoe_xy[0,:], out=open_profile_xy)
+                np.add(open_profile_xy, horseshoe_xy[0,:], out=open_profile_xy)
+                closed_profile_xy = closed_profile_xy_buffer[:num_profile_samples]
+                np.multiply(profile_abscissa[:,np.newaxis], horseshoe_xy[2,:] - horseshoe_xy[1,:], out=closed_profile_xy)
+                np.add(closed_profile_xy, horseshoe_xy[1,:], out=closed_profile_xy)
+
+                # Sample the raster Z in those interpolated (X, Y) locations
+                open_profile_z = sample_raster_array(
+                    window_raster_grid,
+                    window_raster_geotransform,
+                    open_profile_xy[:,0],
+                    open_profile_xy[:,1],
+                )
+                closed_profile_z = sample_raster_array(
+                    window_raster_grid,
+                    window_raster_geotransform,
+                    closed_profile_xy[:,0],
+                    closed_profile_xy[:,1],
+                )
+
+                # Render only if there is no NaN in the profiles
+                if np.all(np.isfinite(open_profile_z)) and np.all(np.isfinite(closed_profile_z)):
+                    # Create line features
+                    for i in range(num_profile_samples):
+                        line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
+                        line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+                        line_geometry.AddPoint(open_profile_xy[i,0], open_profile_xy[i,1], open_profile_z[i])
+                        line_geometry.AddPoint(closed_profile_xy[i,0], closed_profile_xy[i,1], closed_profile_z[i])
+                        line_feature.SetGeometry(line_geometry)
+                        output_lines_layer.CreateFeature(line_feature)
+                        line_feature = None
+
+                    valid_profile_count += 1
+                else:
+                    invalid_profile_count += 1
+
+                expected_pointcount_count += 1
             else:
-                invalid_profile_count += 1
-
-            expected_pointcount_count += 1
-        else:
-            # Point count not equal to 4, skip this geometry and warn.
-            # (The horseshoe layer may be flawed, which we can tolerate here.)
-            unexpected_pointcount_count += 1
+                # Point count not equal to 4, skip this geometry and warn.
+                # (The horseshoe layer may be flawed, which we can tolerate here.)
+                unexpected_pointcount_count += 1
+    except BaseException:
+        output_lines_layer.RollbackTransaction()
+        raise
+    output_lines_layer.CommitTransaction()
+
+    # The spatial index is built once all features are in place
+    result = output_lines_datasrc.ExecuteSQL(
+        f"SELECT CreateSpatialIndex('rendered_horseshoe_lines', '{output_lines_layer.GetGeometryColumn()}')"
+    )
+    output_lines_datasrc.ReleaseResultSet(result)
 
     logging.info(f"processed {expected_pointcount_count} horseshoe geometries")
     if unexpected_pointcount_count != 0:
@@ -1,4 +1,4 @@
-from hydroadjust.sampling import BoundingBox, get_raster_window, get_raster_interpolator
+from hydroadjust.sampling import BoundingBox, TileCache, sample_raster_array
 
 from osgeo import gdal, ogr
 import numpy as np
@@ -31,6 +31,10 @@ def main():
 
     input_raster_dataset = gdal.Open(input_raster_path)
 
+    # Decoded raster blocks are cached, as neighboring objects often need
+    # windows from the same blocks
+    input_raster_tile_cache = TileCache(input_raster_dataset)
+
     input_lines_datasrc = ogr.Open(input_lines_path)
     input_lines_layer = input_lines_datasrc.GetLayer()
 
@@ -40,6 +44,7 @@ def main():
         "rendered_lines",
         srs=input_lines_layer.GetSpatialRef(),
         geom_type=ogr.wkbLineString25D,
+        options=['SPATIAL_INDEX=NO'],
     )
     output_lines_layer = output_lines_datasrc.GetLayer()
 
@@ -49,53 +54,70 @@ def main():
     valid_sampling_count = 0
     invalid_sampling_count = 0
 
-    for input_line_feature in tqdm(input_lines_layer, ascii=True, unit="obj"):
-        input_line_geometry = input_line_feature.GetGeometryRef()
-
-        # Rule out unexpected geometry types (apparently calling .GetGeomType() on
-        # the layer yields weird results)
-        if not (input_line_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
-            raise ValueError("encountered unexpected geometry type")
-
-        if input_line_geometry.GetPointCount() == 2:
-            # We want to consider only the X and Y of the geometry
-            input_line_xy = np.array(input_line_geometry.GetPoints())[:,:2]
-
-            input_line_bbox = BoundingBox(
-                x_min=np.min(input_line_xy[:,0]),
-                x_max=np.max(input_line_xy[:,0]),
-                y_min=np.min(input_line_xy[:,1]),
-                y_max=np.max(input_line_xy[:,1]),
-            )
-
-            # Get a raster window just covering this line object
-            window_raster_dataset = get_raster_window(input_raster_dataset, input_line_bbox)
-
-            window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
-
-            # Get raster Z for the respective endpoints
-            input_line_z = window_raster_interpolator((input_line_xy[:,0], input_line_xy[:,1]))
-
-            # Render only if no Z value is NaN
-            if np.all(np.isfinite(input_line_z)):
-                # Create output feature
-                output_line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
-                output_line_geometry = ogr.Geometry(ogr.wkbLineString25D)
-                output_line_geometry.AddPoint(input_line_xy[0,0], input_line_xy[0,1], input_line_z[0])
-                output_line_geometry.AddPoint(input_line_xy[1,0], input_line_xy[1,1], input_line_z[1])
-                output_line_feature.SetGeometry(output_line_geometry)
-                output_lines_layer.CreateFeature(output_line_feature)
-                output_line_feature = None
-
-                valid_sampling_count += 1
+    # All features are written in a single transaction, as committing every
+    # feature separately is very slow with GeoPackage
+    output_lines_layer.StartTransaction()
+    try:
+        for input_line_feature in tqdm(input_lines_layer, ascii=True, unit="obj"):
+            input_line_geometry = input_line_feature.GetGeometryRef()
+
+            # Rule out unexpected geometry types (apparently calling .GetGeomType() on
+            # the layer yields weird results)
+            if not (input_line_geometry.GetGeometryType() in ACCEPTABLE_GEOMETRY_TYPES):
+                raise ValueError("encountered unexpected geometry type")
+
+            if input_line_geometry.GetPointCount() == 2:
+                # We want to consider only the X and Y of the geometry
+                input_line_xy = np.array(input_line_geometry.GetPoints())[:,:2]
+
+                input_line_bbox = BoundingBox(
+                    x_min=np.min(input_line_xy[:,0]),
+                    x_max=np.max(input_line_xy[:,0]),
+                    y_min=np.min(input_line_xy[:,1]),
+                    y_max=np.max(input_line_xy[:,1]),
+                )
+
+                # Get a raster window just covering this line object
+                window_raster_grid, window_raster_geotransform = input_raster_tile_cache.get_window(input_line_bbox)
+
+                # Get raster Z for the respective endpoints
+                input_line_z = sample_raster_array(
+                    window_raster_grid,
+                    window_raster_geotransform,
+                    input_line_xy[:,0],
+                    input_line_xy[:,1],
+                )
+
+                # Render only if no Z value is NaN
+                if np.all(np.isfinite(input_line_z)):
+                    # Create output feature
+                    output_line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
+                    output_line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+                    output_line_geometry.AddPoint(input_line_xy[0,0], input_line_xy[0,1], input_line_z[0])
+                    output_line_geometry.AddPoint(input_line_xy[1,0], input_line_xy[1,1], input_line_z[1])
+                    output_line_feature.SetGeometry(output_line_geometry)
+                    output_lines_layer.CreateFeature(output_line_feature)
+                    output_line_feature = None
+
+                    valid_sampling_count += 1
+                else:
+                    invalid_sampling_count += 1
+
+                expected_pointcount_count += 1
             else:
-                invalid_sampling_count += 1
-
-            expected_pointcount_count += 1
-        else:
-            # Point count not equal to 2, skip this geometry and warn.
-            # (The input layer may be flawed, which we can tolerate here.)
-            unexpected_pointcount_count += 1
+                # Point count not equal to 2, skip this geometry and warn.
+                # (The input layer may be flawed, which we can tolerate here.)
+                unexpected_pointcount_count += 1
+    except BaseException:
+        output_lines_layer.RollbackTransaction()
+        raise
+    output_lines_layer.CommitTransaction()
+
+    # The spatial index is built once all features are in place
+    result = output_lines_datasrc.ExecuteSQL(
+        f"SELECT CreateSpatialIndex('rendered_lines', '{output_lines_layer.GetGeometryColumn()}')"
+    )
+    output_lines_datasrc.ReleaseResultSet(result)
 
     logging.info(f"processed {expected_pointcount_count} line geometries")
     if unexpected_pointcount_count != 0:
@@ -1,8 +1,9 @@
 from osgeo import gdal, ogr
-from scipy.interpolate import RegularGridInterpolator
 import numpy as np
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+
+from ._kernels import interpolate_bilinear
 
 
 # The ordering of window X and Y bounds is a mess in GDAL (compare e.g.
@@ -14,27 +15,20 @@ BoundingBox = namedtuple(
 )
 
 
-def get_raster_window(dataset, bbox):
+def _get_window_extent(geotransform, bbox):
     """
-    Return a window of the input raster dataset, containing at least the
-    provided bounding box.
-    
-    :param dataset: Source raster dataset
-    :type dataset: GDAL Dataset object
-    :param bbox: Window bound coordinates
-    :type bbox: hydroadjust.sampling.BoundingBox object
-    :returns: GDAL Dataset object for the requested window
+    Return the pixel extent (col_min, col_max, row_min, row_max) of a window
+    containing at least the provided bounding box. col_max and row_max are
+    exclusive.
     """
     
-    input_geotransform = dataset.GetGeoTransform()
-    
-    if input_geotransform[2] != 0.0 or input_geotransform[4] != 0.0:
+    if geotransform[2] != 0.0 or geotransform[4] != 0.0:
         raise ValueError("geotransforms with rotation are unsupported")
     
-    input_offset_x = input_geotransform[0]
-    input_offset_y = input_geotransform[3]
-    input_pixelsize_x = input_geotransform[1]
-    input_pixelsize_y = input_geotransform[5]
+    input_offset_x = geotransform[0]
+    input_offset_y = geotransform[3]
+    input_pixelsize_x = geotransform[1]
+    input_pixelsize_y = geotransform[5]
     
     # We want to find window coordinates that:
     # a) are aligned to the source raster pixels
@@ -51,6 +45,30 @@ def get_raster_window(dataset, bbox):
     row_min = int(np.floor(min(raw_y_min_row_float, raw_y_max_row_float))) - 1
     row_max = int(np.ceil(max(raw_y_min_row_float, raw_y_max_row_float))) + 1
     
+    return col_min, col_max, row_min, row_max
+
+
+def get_raster_window(dataset, bbox):
+    """
+    Return a window of the input raster dataset, containing at least the
+    provided bounding box.
+    
+    :param dataset: Source raster dataset
+    :type dataset: GDAL Dataset object
+    :param bbox: Window bound coordinates
+    :type bbox: hydroadjust.sampling.BoundingBox object
+    :returns: GDAL Dataset object for the requested window
+    """
+    
+    input_geotransform = dataset.GetGeoTransform()
+    
+    input_offset_x = input_geotransform[0]
+    input_offset_y = input_geotransform[3]
+    input_pixelsize_x = input_geotransform[1]
+    input_pixelsize_y = input_geotransform[5]
+    
+    col_min, col_max, row_min, row_max = _get_window_extent(input_geotransform, bbox)
+    
     x_col_min = input_offset_x + input_pixelsize_x * col_min
     x_col_max = input_offset_x + input_pixelsize_x * col_max
     y_row_min = input_offset_y + input_pixelsize_y * row_min
@@ -90,54 +108,354 @@ def get_raster_window(dataset, bbox):
 
 def get_raster_interpolator(dataset):
     """
-    Return a scipy.interpolate.RegularGridInterpolator corresponding to a GDAL
-    raster.
+    Return a bilinear interpolator corresponding to a GDAL raster. Like a
+    scipy.interpolate.RegularGridInterpolator, the interpolator is called
+    with either an (x, y) tuple or an array with X and Y along its last axis,
+    e.g. of shape (N, 2). It returns NaN outside the area between the
+    outermost cell centers and around NODATA cells.
     
     :param dataset: Raster dataset in which to interpolate
     :type dataset: GDAL Dataset object
-    :returns: RegularGridInterpolator accepting georeferenced X and Y input
+    :returns: Function accepting georeferenced X and Y input
     """
     
     geotransform = dataset.GetGeoTransform()
     band = dataset.GetRasterBand(1)
     nodata_value = band.GetNoDataValue()
-    z_grid = band.ReadAsArray()
-    num_rows, num_cols = z_grid.shape
+    z_grid = _to_float32_with_nan(band.ReadAsArray(), nodata_value)
     
     if geotransform[2] != 0.0 or geotransform[4] != 0.0:
         raise ValueError("geotransforms with rotation are unsupported")
     
-    # X and Y values for the individual columns/rows of the raster. The 0.5 is
-    # added in order to obtain the coordinates of the cell centers rather than
-    # the corners.
-    x_values = geotransform[0] + geotransform[1]*(0.5+np.arange(num_cols))
-    y_values = geotransform[3] + geotransform[5]*(0.5+np.arange(num_rows))
-
-    # RegularGridInterpolator requires the x and y arrays to be in strictly
-    # increasing order, accommodate this
-    if geotransform[1] > 0.0:
-        col_step = 1
-    else:
-        col_step = -1
-        x_values = np.flip(x_values)
-
-    if geotransform[5] > 0.0:
-        row_step = 1
-    else:
-        row_step = -1
-        y_values = np.flip(y_values)
-        
-    # NODATA values must be replaced with NaN for interpolation purposes
-    z_grid[z_grid == nodata_value] = np.nan
-    
-    # The grid must be transposed to swap (row, col) coordinates into (x, y)
-    # order.
-    interpolator = RegularGridInterpolator(
-        points=(x_values, y_values),
-        values=z_grid[::row_step, ::col_step].transpose(),
-        method='linear',
-        bounds_error=False,
-        fill_value=np.nan,
-    )
+    def interpolator(xy):
+        if isinstance(xy, tuple):
+            x, y = xy
+        else:
+            xy = np.asarray(xy)
+            if xy.shape[-1:] != (2,):
+                raise ValueError("points must have X and Y along the last axis")
+            x, y = xy[...,0], xy[...,1]
+        return sample_raster_array(z_grid, geotransform, x, y)
     
     return interpolator
+
+
+def _to_float32_with_nan(z_grid, nodata_value):
+    """
+    Convert raster values to float32, with NODATA values replaced by NaN for
+    interpolation purposes.
+    """
+
+    if nodata_value is None:
+        return z_grid.astype(np.float32)
+
+    return np.where(z_grid == nodata_value, np.float32(np.nan), z_grid.astype(np.float32))
+
+
+class TileCache:
+    """
+    Least-recently-used cache of decoded raster blocks.
+
+    Blocks are read at the native block size of the raster band, so that
+    windows which overlap the same blocks share the decoded data instead of
+    decoding it again for every window. Cached blocks are float32 arrays
+    (half the memory of float64, and precise enough for elevations) with
+    NODATA values replaced by NaN.
+
+    :param dataset: Raster dataset to read from (band 1 is used)
+    :type dataset: GDAL Dataset object
+    :param max_tiles: Maximum number of blocks to keep in the cache
+    :type max_tiles: int
+    """
+
+    def __init__(self, dataset, max_tiles=256):
+        self.geotransform = dataset.GetGeoTransform()
+
+        if self.geotransform[2] != 0.0 or self.geotransform[4] != 0.0:
+            raise ValueError("geotransforms with rotation are unsupported")
+
+        self.band = dataset.GetRasterBand(1)
+        self.nodata_value = self.band.GetNoDataValue()
+        self.num_cols = dataset.RasterXSize
+        self.num_rows = dataset.RasterYSize
+        self.tile_num_cols, self.tile_num_rows = self.band.GetBlockSize()
+        self.max_tiles = max_tiles
+
+        self._tiles = OrderedDict()
+
+    @property
+    def num_tile_cols(self):
+        return -(-self.num_cols // self.tile_num_cols)
+
+    def get_tile(self, tile_col, tile_row):
+        """
+        Return the block at the given block column and row. Blocks at the
+        right and bottom edges of the raster may be smaller than the native
+        block size.
+        """
+
+        key = (tile_col, tile_row)
+
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+
+        col_off = tile_col * self.tile_num_cols
+        row_off = tile_row * self.tile_num_rows
+        tile = _to_float32_with_nan(
+            self.band.ReadAsArray(
+                col_off,
+                row_off,
+                min(self.tile_num_cols, self.num_cols - col_off),
+                min(self.tile_num_rows, self.num_rows - row_off),
+            ),
+            self.nodata_value,
+        )
+
+        self._tiles[key] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+
+        return tile
+
+    def read_window(self, col_off, row_off, num_cols, num_rows):
+        """
+        Return a window of the raster, assembled from cached blocks. Parts of
+        the window outside the raster are filled with NaN.
+        """
+
+        window = np.full((num_rows, num_cols), np.nan, dtype=np.float32)
+
+        # Part of the window actually covered by the raster
+        col_min = max(col_off, 0)
+        col_max = min(col_off + num_cols, self.num_cols)
+        row_min = max(row_off, 0)
+        row_max = min(row_off + num_rows, self.num_rows)
+
+        if col_min >= col_max or row_min >= row_max:
+            return window
+
+        for tile_row in range(row_min // self.tile_num_rows, (row_max - 1) // self.tile_num_rows + 1):
+            for tile_col in range(col_min // self.tile_num_cols, (col_max - 1) // self.tile_num_cols + 1):
+                tile = self.get_tile(tile_col, tile_row)
+                tile_col_off = tile_col * self.tile_num_cols
+                tile_row_off = tile_row * self.tile_num_rows
+
+                # Overlap between the window and this block
+                overlap_col_min = max(col_min, tile_col_off)
+                overlap_col_max = min(col_max, tile_col_off + tile.shape[1])
+                overlap_row_min = max(row_min, tile_row_off)
+                overlap_row_max = min(row_max, tile_row_off + tile.shape[0])
+
+                window[
+                    overlap_row_min-row_off:overlap_row_max-row_off,
+                    overlap_col_min-col_off:overlap_col_max-col_off,
+                ] = tile[
+                    overlap_row_min-tile_row_off:overlap_row_max-tile_row_off,
+                    overlap_col_min-tile_col_off:overlap_col_max-tile_col_off,
+                ]
+
+        return window
+
+    def get_window(self, bbox):
+        """
+        Return a window of the raster containing at least the provided
+        bounding box, like get_raster_window(), but as an array read through
+        the cache.
+
+        :param bbox: Window bound coordinates
+        :type bbox: hydroadjust.sampling.BoundingBox object
+        :returns: Tuple (z_grid, geotransform) for the requested window, with
+            NODATA and areas outside the raster as NaN
+        """
+
+        col_min, col_max, row_min, row_max = _get_window_extent(self.geotransform, bbox)
+
+        window = self.read_window(col_min, row_min, col_max - col_min, row_max - row_min)
+        window_geotransform = (
+            self.geotransform[0] + self.geotransform[1] * col_min,
+            self.geotransform[1],
+            0.0,
+            self.geotransform[3] + self.geotransform[5] * row_min,
+            0.0,
+            self.geotransform[5],
+        )
+
+        return window, window_geotransform
+
+
+def _interpolate_grid(z_grid, rows, cols):
+    """
+    Bilinearly interpolate a grid at fractional row/column indices, where
+    integer indices correspond to cell centers. Returns NaN beyond the
+    outermost cell centers.
+    """
+
+    z = np.empty(np.shape(rows), dtype=np.float32)
+    interpolate_bilinear(z_grid, rows, cols, z)
+
+    return z
+
+
+def _get_fractional_indices(geotransform, x, y):
+    """
+    Convert georeferenced X and Y to fractional column and row indices,
+    with integer indices at the cell centers.
+    """
+
+    if geotransform[2] != 0.0 or geotransform[4] != 0.0:
+        raise ValueError("geotransforms with rotation are unsupported")
+
+    # The 0.5 is subtracted in order to place the integer indices at the cell
+    # centers rather than the corners.
+    cols = (x - geotransform[0]) / geotransform[1] - 0.5
+    rows = (y - geotransform[3]) / geotransform[5] - 0.5
+
+    return cols, rows
+
+
+def sample_raster_array(z_grid, geotransform, x, y):
+    """
+    Bilinearly interpolate a raster grid in georeferenced X and Y. This is
+    what the interpolator from get_raster_interpolator() does, for a grid
+    that is already in memory.
+
+    :param z_grid: Raster values, with NODATA represented as NaN
+    :type z_grid: 2D numpy array
+    :param geotransform: GDAL geotransform of the raster grid
+    :type geotransform: sequence of 6 floats
+    :param x: X coordinates to sample
+    :type x: numpy array or scalar
+    :param y: Y coordinates to sample
+    :type y: numpy array or scalar
+    :returns: Interpolated Z values, NaN outside the raster and near NODATA
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    cols, rows = _get_fractional_indices(geotransform, x, y)
+    z = _interpolate_grid(z_grid, rows.ravel(), cols.ravel())
+
+    return z.reshape(x.shape)
+
+
+def sample_raster(tile_cache, x, y):
+    """
+    Bilinearly interpolate a raster in georeferenced X and Y, reading only
+    the raster blocks that are needed through a TileCache.
+
+    The points are processed block by block, in row-major block order, so
+    that every block is decoded only once as long as the cache can hold a
+    row of blocks.
+
+    :param tile_cache: Cache of the raster to sample
+    :type tile_cache: hydroadjust.sampling.TileCache object
+    :param x: X coordinates to sample
+    :type x: numpy array or scalar
+    :param y: Y coordinates to sample
+    :type y: numpy array or scalar
+    :returns: Interpolated Z values, NaN outside the raster and near NODATA
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    cols, rows = _get_fractional_indices(tile_cache.geotransform, x.ravel(), y.ravel())
+    z = np.full(cols.shape, np.nan, dtype=np.float32)
+
+    # Points beyond the outermost cell centers remain NaN
+    inside_index = np.flatnonzero(
+        (cols >= 0.0) & (cols <= tile_cache.num_cols - 1)
+        & (rows >= 0.0) & (rows <= tile_cache.num_rows - 1)
+    )
+
+    # Block holding the upper left of the 2x2 cells used for each point
+    tile_col = np.floor(cols[inside_index]).astype(np.int64) // tile_cache.tile_num_cols
+    tile_row = np.floor(rows[inside_index]).astype(np.int64) // tile_cache.tile_num_rows
+    tile_key = tile_row * tile_cache.num_tile_cols + tile_col
+
+    tile_order = np.argsort(tile_key, kind='stable')
+    tile_groups = np.split(
+        tile_order,
+        np.flatnonzero(np.diff(tile_key[tile_order])) + 1,
+    )
+
+    for tile_group in tile_groups:
+        if tile_group.size == 0:
+            continue
+
+        col_off = tile_col[tile_group[0]] * tile_cache.tile_num_cols
+        row_off = tile_row[tile_group[0]] * tile_cache.tile_num_rows
+
+        # The block plus one pixel to the right and below, to cover the
+        # interpolation neighbors, clipped to the raster
+        window = tile_cache.read_window(
+            col_off,
+            row_off,
+            min(tile_cache.tile_num_cols + 1, tile_cache.num_cols - col_off),
+            min(tile_cache.tile_num_rows + 1, tile_cache.num_rows - row_off),
+        )
+
+        point_index = inside_index[tile_group]
+        z[point_index] = _interpolate_grid(
+            window,
+            rows[point_index] - row_off,
+            cols[point_index] - col_off,
+        )
+
+    return z.reshape(x.shape)
+
+
+def get_horseshoe_profiles(horseshoe_xy, max_sample_dist):
+    """
+    Compute the sample locations along the open (AD) and closed (BC) profiles
+    of a batch of horseshoe objects.
+
+    Each horseshoe gets the same number of samples on both of its profiles
+    (at least 2), chosen such that the sampling distance on the longer
+    profile does not exceed max_sample_dist. The samples of all horseshoes
+    are returned concatenated, in feature order.
+
+    :param horseshoe_xy: X and Y of the ABCD points of each horseshoe
+    :type horseshoe_xy: numpy array of shape (N, 4, 2)
+    :param max_sample_dist: Maximum allowed sampling distance on profiles
+    :type max_sample_dist: float
+    :returns: Tuple (feature_index, open_profile_xy, closed_profile_xy) of
+        arrays with shapes (M,), (M, 2) and (M, 2), where feature_index
+        gives the horseshoe each sample belongs to
+    """
+
+    horseshoe_xy = np.asarray(horseshoe_xy, dtype=np.float64)
+    num_horseshoes = horseshoe_xy.shape[0]
+
+    # Open profile A->D, closed profile B->C
+    open_profile_delta = horseshoe_xy[:, 3, :] - horseshoe_xy[:, 0, :]
+    closed_profile_delta = horseshoe_xy[:, 2, :] - horseshoe_xy[:, 1, :]
+
+    longest_profile_length = np.maximum(
+        np.hypot(open_profile_delta[:, 0], open_profile_delta[:, 1]),
+        np.hypot(closed_profile_delta[:, 0], closed_profile_delta[:, 1]),
+    )
+    num_profile_samples = np.maximum(
+        2,
+        np.ceil(longest_profile_length / max_sample_dist).astype(np.int64) + 1,
+    )
+
+    # Along-profile coordinates in [0, 1] for all samples of all horseshoes,
+    # laid out back-to-back
+    feature_index = np.repeat(np.arange(num_horseshoes), num_profile_samples)
+    first_sample_index = np.cumsum(num_profile_samples) - num_profile_samples
+    sample_index = np.arange(feature_index.size) - first_sample_index[feature_index]
+    profile_abscissa = sample_index / (num_profile_samples[feature_index] - 1)
+
+    open_profile_xy = (
+        horseshoe_xy[feature_index, 0, :]
+        + profile_abscissa[:, np.newaxis]*open_profile_delta[feature_index]
+    )
+    closed_profile_xy = (
+        horseshoe_xy[feature_index, 1, :]
+        + profile_abscissa[:, np.newaxis]*closed_profile_delta[feature_index]
+    )
+
+    return feature_index, open_profile_xy, closed_profile_xy
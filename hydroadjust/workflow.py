@@ -4,17 +4,24 @@ This module provides high-level functions that can be easily used in Jupyter not
 """
 
 import os
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, ExitStack
+from functools import partial, wraps
 from pathlib import Path
-from typing import Union, Optional, List, Tuple
+from typing import Union, Optional, List, Tuple, Callable
 import logging
 
 import numpy as np
 import geopandas as gpd
-from shapely.geometry import box
+import pyogrio
+import shapely
 from osgeo import gdal, ogr
 from tqdm import tqdm
 
-from .sampling import BoundingBox, get_raster_window, get_raster_interpolator
+from .sampling import sample_raster, sample_raster_array, get_horseshoe_profiles, TileCache, _to_float32_with_nan
+from ._kernels import set_num_threads
 from .burning import burn_lines
 
 # Configure logging
@@ -24,17 +31,388 @@ logger = logging.getLogger(__name__)
 gdal.UseExceptions()
 ogr.UseExceptions()
 
+# GDAL configuration applied while a workflow is active. Sidecar files (e.g.
+# .aux.xml, .tfw) are still found, as directory listings are only disabled
+# rather than assumed empty. The GPKG outputs are intermediate files, so
+# SQLite durability is traded for speed.
+GDAL_CONFIG_OPTIONS = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'TRUE',
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+    'VSI_CACHE': 'TRUE',
+    'OGR_SQLITE_CACHE': '512',
+    'OGR_SQLITE_SYNCHRONOUS': 'OFF',
+    'GPKG_FOREIGN_KEY_CHECK': 'OFF',
+}
+
+# GDAL block cache size (in bytes) while a workflow is active, rather than
+# the default of 5% of RAM adding up when several workflows run side by side.
+# This is set with gdal.SetCacheMax(), as the GDAL_CACHEMAX configuration
+# option is only read once per process.
+GDAL_CACHE_MAX = 512 * 1024 * 1024
+
+
+# Name of the layer holding all lines to burn after merging
+MERGED_LINES_LAYER = 'combined_lines'
+
+# The adjusted DTM is written as a tiled GeoTIFF, one row of tiles at a time
+BURN_BLOCK_SIZE = 256
+GTIFF_CREATION_OPTIONS = [
+    'TILED=YES',
+    f'BLOCKXSIZE={BURN_BLOCK_SIZE}',
+    f'BLOCKYSIZE={BURN_BLOCK_SIZE}',
+    'COMPRESS=ZSTD',
+    'NUM_THREADS=ALL_CPUS',
+    'BIGTIFF=IF_SAFER',
+]
+
+
+@contextmanager
+def gdal_config_options(options: dict):
+    """
+    Context manager setting GDAL configuration options, restoring the
+    previous values on exit.
+    
+    Parameters:
+    -----------
+    options : dict
+        Mapping of configuration option names to values
+    """
+    previous_options = {key: gdal.GetConfigOption(key) for key in options}
+    for key, value in options.items():
+        gdal.SetConfigOption(key, value)
+    try:
+        yield
+    finally:
+        for key, value in previous_options.items():
+            gdal.SetConfigOption(key, value)
+
+
+@contextmanager
+def gdal_cache_max(num_bytes: int):
+    """
+    Context manager setting the size of the GDAL block cache, restoring the
+    previous size on exit.
+    
+    Parameters:
+    -----------
+    num_bytes : int
+        Maximum size of the block cache in bytes
+    """
+    previous_num_bytes = gdal.GetCacheMax()
+    gdal.SetCacheMax(num_bytes)
+    try:
+        yield
+    finally:
+        gdal.SetCacheMax(previous_num_bytes)
+
+
+# Below this number of sample points, sampling is done in-process, as
+# starting worker processes would take longer than the sampling itself
+PARALLEL_MIN_SAMPLES = 100_000
+
+# The decoded DTM is kept in the output directory as a float32 .npy file
+# (with NODATA as NaN), which the samplers memory-map instead of decoding the
+# raster again. The sidecar JSON file identifies the source it was made from.
+DEM_ARRAY_NAME = 'dem.f32.npy'
+DEM_ARRAY_METADATA_NAME = 'dem.f32.json'
+
+# Minimum number of raster rows to decode at a time when writing the DTM array
+DEM_ARRAY_READ_ROWS = 256
+
+# Largest DTM (in bytes, as float32) that is decoded to an array. Larger DTMs
+# are sampled block by block through a TileCache instead, which decodes only
+# the blocks the sample points fall in.
+DEM_ARRAY_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# GDAL block cache size (in bytes) of each sampling worker process. The
+# workers keep their own decoded blocks, so GDAL needs little cache.
+SAMPLING_WORKER_CACHE_MAX = 64 * 1024 * 1024
+
+
+def _get_dem_array_metadata(dtm_raster: Path, dataset) -> dict:
+    """
+    Describe the DTM raster that a DTM array is made from. The array is
+    considered current as long as this description is unchanged.
+    """
+    # VSIStatL also handles GDAL virtual file system paths (/vsicurl/ etc.)
+    source_stat = gdal.VSIStatL(str(dtm_raster))
+    return {
+        'source': str(dtm_raster),
+        'source_size': source_stat.size,
+        'source_mtime': source_stat.mtime,
+        'shape': [dataset.RasterYSize, dataset.RasterXSize],
+        'dtype': 'float32',
+        'geotransform': list(dataset.GetGeoTransform()),
+    }
+
+
+def _write_dem_array(dataset, array_file: Path) -> None:
+    """
+    Decode the first band of a raster into a float32 .npy file, with NODATA
+    values replaced by NaN. The raster is read in strips of whole blocks.
+    """
+    band = dataset.GetRasterBand(1)
+    nodata_value = band.GetNoDataValue()
+    num_cols, num_rows = dataset.RasterXSize, dataset.RasterYSize
+    
+    block_num_rows = band.GetBlockSize()[1]
+    strip_num_rows = block_num_rows * max(1, DEM_ARRAY_READ_ROWS // block_num_rows)
+    
+    # Written under a temporary name, so that an interrupted write never
+    # leaves a truncated array behind
+    partial_file = array_file.with_name(array_file.name + '.partial')
+    z_grid = np.lib.format.open_memmap(
+        partial_file, mode='w+', dtype=np.float32, shape=(num_rows, num_cols)
+    )
+    for row_off in range(0, num_rows, strip_num_rows):
+        strip_rows = min(strip_num_rows, num_rows - row_off)
+        z_grid[row_off:row_off + strip_rows] = _to_float32_with_nan(
+            band.ReadAsArray(0, row_off, num_cols, strip_rows), nodata_value
+        )
+    z_grid.flush()
+    del z_grid
+    
+    os.replace(partial_file, array_file)
+
+
+def _create_dem_tile_cache(dataset) -> TileCache:
+    """
+    Create a TileCache for sampling a DTM, large enough to hold two rows of
+    blocks, as needed by sample_raster() to decode every block only once.
+    """
+    tile_cache = TileCache(dataset)
+    tile_cache.max_tiles = max(tile_cache.max_tiles, 2 * tile_cache.num_tile_cols)
+    return tile_cache
+
+
+def _init_sampling_worker():
+    """
+    Initialize a sampling worker process. The compiled kernel is limited to a
+    single thread, as the workers already use all CPUs between them.
+    """
+    set_num_threads(1)
+    gdal.SetCacheMax(SAMPLING_WORKER_CACHE_MAX)
+
+
+def _sample_array_chunk(dem_array_file: str, geotransform, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Sample a chunk of points in a worker process. The DTM array is
+    memory-mapped, so all workers share the same pages of it.
+    """
+    z_grid = np.load(dem_array_file, mmap_mode='r')
+    return sample_raster_array(z_grid, geotransform, x, y)
+
+
+def _sample_tiles_chunk(dtm_raster: str, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """
+    Sample a chunk of points in a worker process, decoding only the blocks of
+    the DTM raster that the points fall in.
+    """
+    tile_cache = _create_dem_tile_cache(gdal.Open(dtm_raster))
+    return sample_raster(tile_cache, x, y)
+
+
+def _sample_raster_parallel(sample: Callable[[np.ndarray, np.ndarray], np.ndarray],
+                            sample_chunk: Callable[[np.ndarray, np.ndarray], np.ndarray],
+                            x: np.ndarray,
+                            y: np.ndarray,
+                            n_jobs: Optional[int] = 1) -> np.ndarray:
+    """
+    Sample a raster in many points, spreading the work over several processes.
+    
+    Parameters:
+    -----------
+    sample : callable
+        Function sampling the raster in arrays of X and Y, used in-process
+    sample_chunk : callable
+        Picklable function sampling the raster in arrays of X and Y, used by
+        the worker processes
+    x, y : numpy array
+        1D arrays of coordinates to sample
+    n_jobs : int, optional
+        Number of worker processes, or None for the number of CPUs. Negative
+        values count back from the number of CPUs (-1 for all CPUs, -2 for
+        all but one, and so on). Defaults to 1 (no worker processes). Workers are started with "spawn", so a
+        calling script must guard its entry point with
+        ``if __name__ == '__main__':``.
+        
+    Returns:
+    --------
+    numpy array
+        Interpolated Z values (NaN where sampling was not possible)
+    """
+    cpu_count = os.cpu_count() or 1
+    if n_jobs is None:
+        n_jobs = cpu_count
+    elif n_jobs < 0:
+        n_jobs = max(1, cpu_count + 1 + n_jobs)
+    elif n_jobs == 0:
+        raise ValueError("n_jobs must be a positive or negative number of processes, or None")
+    
+    if n_jobs == 1 or len(x) < PARALLEL_MIN_SAMPLES:
+        return sample(x, y)
+    
+    # Order the points by Y, then X, so that each chunk covers a compact band
+    # of the raster and the workers touch disjoint sets of pages
+    point_order = np.lexsort((x, y))
+    chunks = np.array_split(point_order, 4 * n_jobs)
+    
+    z = np.empty(len(x))
+    # Use "spawn" rather than forking a process that has GDAL datasets open
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_sampling_worker,
+    ) as executor:
+        chunk_results = executor.map(
+            sample_chunk,
+            [x[chunk] for chunk in chunks],
+            [y[chunk] for chunk in chunks],
+        )
+        for chunk, chunk_z in zip(chunks, chunk_results):
+            z[chunk] = chunk_z
+    
+    return z
+
+
+def _count_by_block_row(bounds: np.ndarray,
+                        geotransform,
+                        num_rows: int,
+                        block_size: int) -> np.ndarray:
+    """
+    Count the geometries whose bounding boxes touch each raster block row.
+    
+    Parameters:
+    -----------
+    bounds : numpy array
+        Array of shape (N, 4) with (min_x, min_y, max_x, max_y) per geometry
+    geotransform : sequence of 6 floats
+        GDAL geotransform of the raster
+    num_rows : int
+        Number of pixel rows in the raster
+    block_size : int
+        Number of pixel rows per block row
+        
+    Returns:
+    --------
+    numpy array
+        Number of geometries touching each block row
+    """
+    num_block_rows = -(-num_rows // block_size)
+    
+    # Pixel rows covered by each bounding box, padded by one pixel
+    row_a = (bounds[:,1] - geotransform[3]) / geotransform[5]
+    row_b = (bounds[:,3] - geotransform[3]) / geotransform[5]
+    row_min = np.floor(np.minimum(row_a, row_b)) - 1
+    row_max = np.floor(np.maximum(row_a, row_b)) + 1
+    
+    # Geometries entirely outside the raster (or empty) are left out
+    inside = (row_max >= 0) & (row_min < num_rows)
+    block_row_min = np.clip(row_min[inside] // block_size, 0, num_block_rows - 1).astype(np.intp)
+    block_row_max = np.clip(row_max[inside] // block_size, 0, num_block_rows - 1).astype(np.intp)
+    
+    # Each geometry counts from its first block row up to its last one
+    count_change = (
+        np.bincount(block_row_min, minlength=num_block_rows + 1)
+        - np.bincount(block_row_max + 1, minlength=num_block_rows + 1)
+    )
+    return np.cumsum(count_change[:num_block_rows])
+
+
+def _read_linestring_xy(vector_file: Union[str, Path], num_points: int):
+    """
+    Read the X,Y coordinates of all linestrings with the expected number of
+    points from a vector file.
+    
+    Parameters:
+    -----------
+    vector_file : str or Path
+        Path to input vector file (first layer is used)
+    num_points : int
+        Expected number of points per linestring. Other geometries are skipped.
+        
+    Returns:
+    --------
+    tuple
+        (xy, crs) where xy is an array of shape (N, num_points, 2) and crs is
+        the CRS of the layer (or None)
+    """
+    gdf = gpd.read_file(vector_file)
+    geometries = np.asarray(gdf.geometry)
+    
+    expected_geometry = (
+        (shapely.get_type_id(geometries) == shapely.GeometryType.LINESTRING)
+        & (shapely.get_num_coordinates(geometries) == num_points)
+    )
+    if not np.all(expected_geometry):
+        logger.warning(
+            f"Skipped {np.count_nonzero(~expected_geometry)} geometries with point count not equal to {num_points}"
+        )
+    
+    xy = shapely.get_coordinates(geometries[expected_geometry]).reshape(-1, num_points, 2)
+    
+    return xy, gdf.crs
+
+
+def _write_lines_with_z(lines_xyz: np.ndarray, crs, output_lines: Union[str, Path], layer_name: str) -> None:
+    """
+    Write 3D line segments to a new GeoPackage in one bulk operation.
+    
+    Parameters:
+    -----------
+    lines_xyz : numpy array
+        Array of shape (N, 2, 3) with the X,Y,Z of the segment endpoints
+    crs : pyproj.CRS or None
+        CRS of the lines
+    output_lines : str or Path
+        Path to output GeoPackage (replaced if it exists)
+    layer_name : str
+        Name of the output layer
+    """
+    # All linestrings are constructed in a single vectorized call
+    lines_gdf = gpd.GeoDataFrame(geometry=shapely.linestrings(lines_xyz), crs=crs)
+    
+    if os.path.exists(output_lines):
+        os.remove(output_lines)
+    
+    pyogrio.write_dataframe(
+        lines_gdf,
+        output_lines,
+        layer=layer_name,
+        driver='GPKG',
+        geometry_type='LineString Z',
+    )
+
+
+def _with_gdal_config(step):
+    """
+    Decorator applying GDAL_CONFIG_OPTIONS and GDAL_CACHE_MAX while a
+    workflow step runs, also when the workflow is not used as a context
+    manager.
+    """
+    @wraps(step)
+    def configured_step(*args, **kwargs):
+        with gdal_config_options(GDAL_CONFIG_OPTIONS), gdal_cache_max(GDAL_CACHE_MAX):
+            return step(*args, **kwargs)
+    return configured_step
+
 
 class HydroAdjustWorkflow:
     """
     A class to manage the complete hydro adjustment workflow.
+    
+    Each step applies GDAL_CONFIG_OPTIONS and GDAL_CACHE_MAX while it runs.
+    The workflow should be used as a context manager, which also applies them
+    on entry, and restores the previous GDAL configuration and closes the DTM
+    on exit.
     """
     
     def __init__(self, 
                  dtm_raster: Union[str, Path],
                  horseshoe_file: Union[str, Path],
                  line_file: Union[str, Path],
-                 output_dir: Union[str, Path]):
+                 output_dir: Union[str, Path],
+                 dem_array_max_bytes: Optional[int] = DEM_ARRAY_MAX_BYTES):
         """
         Initialize the workflow with input files and output directory.
         
@@ -48,6 +426,10 @@ class HydroAdjustWorkflow:
             Path to the line vector data file
         output_dir : str or Path
             Directory where output files will be created
+        dem_array_max_bytes : int, optional
+            Largest DTM (in bytes, as float32) to decode to an array for
+            sampling, or None for no limit. Larger DTMs are sampled block by
+            block instead.
         """
         self.dtm_raster = Path(dtm_raster)
         self.horseshoe_file = Path(horseshoe_file)
@@ -64,9 +446,127 @@ class HydroAdjustWorkflow:
         self.lines_with_z = self.output_dir / 'lines_with_z.gpkg'
         self.combined_lines = self.output_dir / 'combined_lines.gpkg'
         self.hydro_dtm = self.output_dir / 'hydro_adjusted_dtm.tif'
+        self.dem_array_file = self.output_dir / DEM_ARRAY_NAME
+        self.dem_array_metadata = self.output_dir / DEM_ARRAY_METADATA_NAME
+        self.dem_array_max_bytes = dem_array_max_bytes
+        
+        # The DTM is opened on first use and then shared by all steps, along
+        # with its decoded values
+        self._dem_dataset = None
+        self._dem_array = None
+        self._dem_tile_cache = None
+        
+        self._gdal_config_stack = ExitStack()
         
         logger.info(f"Workflow initialized with output directory: {self.output_dir}")
     
+    @property
+    def dem_dataset(self) -> gdal.Dataset:
+        """
+        GDAL dataset of the DTM raster, opened once per workflow.
+        """
+        if self._dem_dataset is None:
+            self._dem_dataset = gdal.Open(str(self.dtm_raster))
+        return self._dem_dataset
+    
+    @property
+    def dem_array(self) -> np.ndarray:
+        """
+        Decoded DTM values as a read-only float32 memory map, with NODATA as
+        NaN. The array file is written on first use and reused by later
+        workflows with the same output directory, as long as the DTM raster
+        is unchanged.
+        """
+        if self._dem_array is None:
+            metadata = _get_dem_array_metadata(self.dtm_raster, self.dem_dataset)
+            
+            try:
+                with open(self.dem_array_metadata) as metadata_file:
+                    is_current = json.load(metadata_file) == metadata and self.dem_array_file.exists()
+            except (OSError, ValueError):
+                is_current = False
+            
+            if not is_current:
+                logger.info(f"Decoding DTM to {self.dem_array_file}")
+                # The metadata goes first and last, so that it never
+                # describes an array made from another raster
+                try:
+                    os.remove(self.dem_array_metadata)
+                except FileNotFoundError:
+                    pass
+                _write_dem_array(self.dem_dataset, self.dem_array_file)
+                with open(self.dem_array_metadata, 'w') as metadata_file:
+                    json.dump(metadata, metadata_file, indent=2)
+            
+            self._dem_array = np.load(self.dem_array_file, mmap_mode='r')
+        return self._dem_array
+    
+    @property
+    def dem_tile_cache(self) -> TileCache:
+        """
+        TileCache of the DTM raster, for DTMs too large to decode to an array.
+        """
+        if self._dem_tile_cache is None:
+            self._dem_tile_cache = _create_dem_tile_cache(self.dem_dataset)
+        return self._dem_tile_cache
+    
+    @property
+    def use_dem_array(self) -> bool:
+        """
+        Whether the DTM is small enough to be sampled through dem_array,
+        rather than block by block through dem_tile_cache.
+        """
+        if self.dem_array_max_bytes is None:
+            return True
+        num_bytes = self.dem_dataset.RasterXSize * self.dem_dataset.RasterYSize * np.dtype(np.float32).itemsize
+        return num_bytes <= self.dem_array_max_bytes
+    
+    def _sample_dem(self, x: np.ndarray, y: np.ndarray, n_jobs: Optional[int] = 1) -> np.ndarray:
+        """
+        Sample the DTM in arrays of X and Y, through the DTM array or the
+        TileCache depending on the size of the DTM.
+        """
+        if self.use_dem_array:
+            geotransform = self.dem_dataset.GetGeoTransform()
+            z_grid = self.dem_array
+            return _sample_raster_parallel(
+                lambda x, y: sample_raster_array(z_grid, geotransform, x, y),
+                partial(_sample_array_chunk, str(self.dem_array_file), geotransform),
+                x,
+                y,
+                n_jobs,
+            )
+        else:
+            tile_cache = self.dem_tile_cache
+            return _sample_raster_parallel(
+                lambda x, y: sample_raster(tile_cache, x, y),
+                partial(_sample_tiles_chunk, str(self.dtm_raster)),
+                x,
+                y,
+                n_jobs,
+            )
+    
+    def __enter__(self) -> 'HydroAdjustWorkflow':
+        self._gdal_config_stack.enter_context(gdal_config_options(GDAL_CONFIG_OPTIONS))
+        self._gdal_config_stack.enter_context(gdal_cache_max(GDAL_CACHE_MAX))
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            self.close()
+        finally:
+            self._gdal_config_stack.close()
+    
+    def close(self) -> None:
+        """
+        Close the DTM dataset, unmap the DTM array and drop the cached DTM
+        blocks. They are opened again if a step is run afterwards.
+        """
+        self._dem_array = None
+        self._dem_tile_cache = None
+        self._dem_dataset = None
+    
+    @_with_gdal_config
     def get_raster_bounds(self) -> Tuple[float, float, float, float]:
         """
         Get the bounding box of the DTM raster.
@@ -76,7 +576,7 @@ class HydroAdjustWorkflow:
         tuple
             (min_x, min_y, max_x, max_y) bounding box coordinates
         """
-        dataset = gdal.Open(str(self.dtm_raster))
+        dataset = self.dem_dataset
         geotransform = dataset.GetGeoTransform()
         
         if geotransform[2] != 0.0 or geotransform[4] != 0.0:
@@ -104,6 +604,7 @@ class HydroAdjustWorkflow:
         logger.info(f"Raster bounds: ({min_x}, {min_y}, {max_x}, {max_y})")
         return min_x, min_y, max_x, max_y
     
+    @_with_gdal_config
     def filter_vectors_by_bounds(self, 
                                 horseshoe_layer: str = 'dhmhestesko',
                                 line_layer: str = 'dhmlinje') -> None:
@@ -117,16 +618,16 @@ class HydroAdjustWorkflow:
         line_layer : str
             Layer name for line data
         """
-        min_x, min_y, max_x, max_y = self.get_raster_bounds()
-        bbox_geom = box(min_x, min_y, max_x, max_y)
+        raster_bounds = self.get_raster_bounds()
         
         # Filter horseshoe data
         logger.info("Filtering horseshoe data...")
         try:
-            gdf_hs = gpd.read_file(self.horseshoe_file, layer=horseshoe_layer, bbox=bbox_geom)
-            if not gdf_hs.empty:
-                gdf_hs.to_file(self.hs_filtered, driver='GPKG')
-                logger.info(f"Found {len(gdf_hs)} horseshoe features within bounds")
+            num_hs = self._filter_vector_file(
+                self.horseshoe_file, horseshoe_layer, self.hs_filtered, raster_bounds
+            )
+            if num_hs > 0:
+                logger.info(f"Found {num_hs} horseshoe features within bounds")
             else:
                 logger.warning("No horseshoe features found within raster bounds")
         except Exception as e:
@@ -135,15 +636,63 @@ class HydroAdjustWorkflow:
         # Filter line data
         logger.info("Filtering line data...")
         try:
-            gdf_lines = gpd.read_file(self.line_file, layer=line_layer, bbox=bbox_geom)
-            if not gdf_lines.empty:
-                gdf_lines.to_file(self.lines_filtered, driver='GPKG')
-                logger.info(f"Found {len(gdf_lines)} line features within bounds")
+            num_lines = self._filter_vector_file(
+                self.line_file, line_layer, self.lines_filtered, raster_bounds
+            )
+            if num_lines > 0:
+                logger.info(f"Found {num_lines} line features within bounds")
             else:
                 logger.warning("No line features found within raster bounds")
         except Exception as e:
             logger.error(f"Error filtering line data: {e}")
     
+    @staticmethod
+    def _filter_vector_file(input_file: Union[str, Path],
+                            layer: str,
+                            output_file: Union[str, Path],
+                            bounds: Tuple[float, float, float, float]) -> int:
+        """
+        Copy the features of a layer that intersect the given bounds to a new
+        GeoPackage. This runs entirely within GDAL (like ogr2ogr -spat), using
+        the spatial index of the source, and no output is left behind if no
+        features match or the copy fails.
+        
+        Returns:
+        --------
+        int
+            Number of features copied
+        """
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        
+        output_datasrc = None
+        try:
+            output_datasrc = gdal.VectorTranslate(
+                str(output_file),
+                str(input_file),
+                options=gdal.VectorTranslateOptions(
+                    format='GPKG',
+                    layers=[layer],
+                    spatFilter=list(bounds),
+                ),
+            )
+            if output_datasrc is None:
+                raise RuntimeError(f"Failed to copy layer {layer} of {input_file}")
+            num_features = output_datasrc.GetLayerByName(layer).GetFeatureCount()
+            output_datasrc = None
+        except Exception:
+            # Don't leave a partial output behind
+            output_datasrc = None
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            raise
+        
+        if num_features == 0:
+            os.remove(output_file)
+        
+        return num_features
+    
+    @_with_gdal_config
     def sample_line_z(self, input_lines: Union[str, Path], output_lines: Union[str, Path]) -> None:
         """
         Sample elevation from DTM for line endpoints and create 3D lines.
@@ -157,65 +706,31 @@ class HydroAdjustWorkflow:
         """
         logger.info(f"Sampling elevation for lines: {input_lines}")
         
-        input_raster_dataset = gdal.Open(str(self.dtm_raster))
-        input_lines_datasrc = ogr.Open(str(input_lines))
-        input_lines_layer = input_lines_datasrc.GetLayer()
-        
-        # Create output file
-        output_lines_driver = ogr.GetDriverByName("GPKG")
-        if os.path.exists(output_lines):
-            output_lines_driver.DeleteDataSource(str(output_lines))
+        # Get X,Y coordinates of all line endpoints at once
+        input_line_xy, input_lines_crs = _read_linestring_xy(input_lines, 2)
         
-        output_lines_datasrc = output_lines_driver.CreateDataSource(str(output_lines))
-        output_lines_datasrc.CreateLayer(
-            "lines_with_z",
-            srs=input_lines_layer.GetSpatialRef(),
-            geom_type=ogr.wkbLineString25D,
-        )
-        output_lines_layer = output_lines_datasrc.GetLayer()
+        # Sample elevation at all endpoints in one go
+        input_line_z = self._sample_dem(input_line_xy[:,:,0], input_line_xy[:,:,1])
         
-        valid_count = 0
-        invalid_count = 0
+        # A line is only rendered if both endpoints were sampled validly
+        line_valid = np.all(np.isfinite(input_line_z), axis=1)
+        valid_count = int(np.count_nonzero(line_valid))
+        invalid_count = len(input_line_xy) - valid_count
         
-        for input_line_feature in tqdm(input_lines_layer, desc="Processing lines"):
-            input_line_geometry = input_line_feature.GetGeometryRef()
-            
-            if input_line_geometry.GetPointCount() == 2:
-                # Get X,Y coordinates
-                input_line_xy = np.array(input_line_geometry.GetPoints())[:,:2]
-                
-                input_line_bbox = BoundingBox(
-                    x_min=np.min(input_line_xy[:,0]),
-                    x_max=np.max(input_line_xy[:,0]),
-                    y_min=np.min(input_line_xy[:,1]),
-                    y_max=np.max(input_line_xy[:,1]),
-                )
-                
-                # Get raster window for this line
-                window_raster_dataset = get_raster_window(input_raster_dataset, input_line_bbox)
-                window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
-                
-                # Sample elevation at endpoints
-                input_line_z = window_raster_interpolator((input_line_xy[:,0], input_line_xy[:,1]))
-                
-                # Create output feature if sampling is valid
-                if np.all(np.isfinite(input_line_z)):
-                    output_line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
-                    output_line_geometry = ogr.Geometry(ogr.wkbLineString25D)
-                    output_line_geometry.AddPoint(input_line_xy[0,0], input_line_xy[0,1], input_line_z[0])
-                    output_line_geometry.AddPoint(input_line_xy[1,0], input_line_xy[1,1], input_line_z[1])
-                    output_line_feature.SetGeometry(output_line_geometry)
-                    output_lines_layer.CreateFeature(output_line_feature)
-                    valid_count += 1
-                else:
-                    invalid_count += 1
+        output_lines_xyz = np.concatenate(
+            [input_line_xy[line_valid], input_line_z[line_valid][:,:,np.newaxis]],
+            axis=2,
+        )
+        _write_lines_with_z(output_lines_xyz, input_lines_crs, output_lines, "lines_with_z")
         
         logger.info(f"Line sampling complete: {valid_count} valid, {invalid_count} invalid")
     
+    @_with_gdal_config
     def sample_horseshoe_z_lines(self, 
                                  input_horseshoes: Union[str, Path], 
                                  output_lines: Union[str, Path],
-                                 max_sample_dist: Optional[float] = None) -> None:
+                                 max_sample_dist: Optional[float] = None,
+                                 n_jobs: Optional[int] = 1) -> None:
         """
         Sample horseshoe profiles and render as 3D lines.
         
@@ -227,11 +742,13 @@ class HydroAdjustWorkflow:
             Path to output 3D line vector file
         max_sample_dist : float, optional
             Maximum sampling distance along profiles
+        n_jobs : int, optional
+            Number of processes to sample with, or None for the number of
+            CPUs (defaults to 1, see _sample_raster_parallel)
         """
         logger.info(f"Sampling elevation for horseshoes: {input_horseshoes}")
         
-        input_raster_dataset = gdal.Open(str(self.dtm_raster))
-        input_raster_geotransform = input_raster_dataset.GetGeoTransform()
+        input_raster_geotransform = self.dem_dataset.GetGeoTransform()
         
         if max_sample_dist is None:
             # Set to half the diagonal pixel size
@@ -240,90 +757,44 @@ class HydroAdjustWorkflow:
                 input_raster_geotransform[5],
             )
         
-        input_horseshoes_datasrc = ogr.Open(str(input_horseshoes))
-        input_horseshoes_layer = input_horseshoes_datasrc.GetLayer()
-        
-        # Create output file
-        output_lines_driver = ogr.GetDriverByName("GPKG")
-        if os.path.exists(output_lines):
-            output_lines_driver.DeleteDataSource(str(output_lines))
+        # Get X,Y coordinates of all horseshoes at once (ABCD pattern)
+        horseshoe_xy, horseshoe_crs = _read_linestring_xy(input_horseshoes, 4)
         
-        output_lines_datasrc = output_lines_driver.CreateDataSource(str(output_lines))
-        output_lines_datasrc.CreateLayer(
-            "horseshoe_lines_with_z",
-            srs=input_horseshoes_layer.GetSpatialRef(),
-            geom_type=ogr.wkbLineString25D,
+        # Sample locations along the open (A->D) and closed (B->C) profiles
+        feature_index, open_profile_xy, closed_profile_xy = get_horseshoe_profiles(
+            horseshoe_xy, max_sample_dist
         )
-        output_lines_layer = output_lines_datasrc.GetLayer()
         
-        valid_count = 0
-        invalid_count = 0
+        # Sample elevations of both profiles of all horseshoes in one go
+        profile_xy = np.concatenate([open_profile_xy, closed_profile_xy])
+        profile_z = self._sample_dem(profile_xy[:,0], profile_xy[:,1], n_jobs)
+        open_profile_z, closed_profile_z = np.split(profile_z, 2)
         
-        for horseshoe_feature in tqdm(input_horseshoes_layer, desc="Processing horseshoes"):
-            horseshoe_geometry = horseshoe_feature.GetGeometryRef()
-            
-            if horseshoe_geometry.GetPointCount() == 4:
-                # Get X,Y coordinates (ABCD pattern)
-                horseshoe_xy = np.array(horseshoe_geometry.GetPoints())[:,:2]
-                
-                horseshoe_bbox = BoundingBox(
-                    x_min=np.min(horseshoe_xy[:,0]),
-                    x_max=np.max(horseshoe_xy[:,0]),
-                    y_min=np.min(horseshoe_xy[:,1]),
-                    y_max=np.max(horseshoe_xy[:,1]),
-                )
-                
-                # Get raster window
-                window_raster_dataset = get_raster_window(input_raster_dataset, horseshoe_bbox)
-                window_raster_interpolator = get_raster_interpolator(window_raster_dataset)
-                
-                # Calculate profile lengths
-                open_profile_length = np.hypot(
-                    horseshoe_xy[3, 0] - horseshoe_xy[0, 0],
-                    horseshoe_xy[3, 1] - horseshoe_xy[0, 1],
-                )
-                closed_profile_length = np.hypot(
-                    horseshoe_xy[2, 0] - horseshoe_xy[1, 0],
-                    horseshoe_xy[2, 1] - horseshoe_xy[1, 1],
-                )
-                
-                # Determine sampling density
-                longest_profile_length = max(open_profile_length, closed_profile_length)
-                num_profile_samples = max(2, int(np.ceil(longest_profile_length / max_sample_dist)) + 1)
-                
-                # Sample along profiles
-                profile_abscissa = np.linspace(0.0, 1.0, num_profile_samples, endpoint=True)
-                
-                # Open profile A->D, Closed profile B->C
-                open_profile_xy = horseshoe_xy[0,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[3,:] - horseshoe_xy[0,:])
-                closed_profile_xy = horseshoe_xy[1,:] + profile_abscissa[:,np.newaxis]*(horseshoe_xy[2,:] - horseshoe_xy[1,:])
-                
-                # Sample elevations
-                open_profile_z = window_raster_interpolator((open_profile_xy[:,0], open_profile_xy[:,1]))
-                closed_profile_z = window_raster_interpolator((closed_profile_xy[:,0], closed_profile_xy[:,1]))
-                
-                # Create connecting lines if sampling is valid
-                if np.all(np.isfinite(open_profile_z)) and np.all(np.isfinite(closed_profile_z)):
-                    for i in range(num_profile_samples):
-                        output_line_feature = ogr.Feature(output_lines_layer.GetLayerDefn())
-                        output_line_geometry = ogr.Geometry(ogr.wkbLineString25D)
-                        output_line_geometry.AddPoint(
-                            open_profile_xy[i,0], open_profile_xy[i,1], open_profile_z[i]
-                        )
-                        output_line_geometry.AddPoint(
-                            closed_profile_xy[i,0], closed_profile_xy[i,1], closed_profile_z[i]
-                        )
-                        output_line_feature.SetGeometry(output_line_geometry)
-                        output_lines_layer.CreateFeature(output_line_feature)
-                    valid_count += 1
-                else:
-                    invalid_count += 1
+        # A horseshoe is only rendered if all of its samples are valid
+        invalid_sample = ~(np.isfinite(open_profile_z) & np.isfinite(closed_profile_z))
+        horseshoe_valid = np.bincount(
+            feature_index, weights=invalid_sample, minlength=len(horseshoe_xy)
+        ) == 0
+        valid_count = int(np.count_nonzero(horseshoe_valid))
+        invalid_count = len(horseshoe_xy) - valid_count
+        
+        # Create connecting lines for the valid horseshoes
+        sample_valid = horseshoe_valid[feature_index]
+        output_lines_xyz = np.stack(
+            [
+                np.column_stack([open_profile_xy, open_profile_z])[sample_valid],
+                np.column_stack([closed_profile_xy, closed_profile_z])[sample_valid],
+            ],
+            axis=1,
+        )
+        _write_lines_with_z(output_lines_xyz, horseshoe_crs, output_lines, "horseshoe_lines_with_z")
         
         logger.info(f"Horseshoe sampling complete: {valid_count} valid, {invalid_count} invalid")
     
+    @_with_gdal_config
     def merge_line_files(self, input_files: List[Union[str, Path]], output_file: Union[str, Path]) -> None:
         """
-        Merge multiple line files into a single GeoPackage.
+        Merge multiple line files into a single GeoPackage layer.
         
         Parameters:
         -----------
@@ -334,25 +805,39 @@ class HydroAdjustWorkflow:
         """
         logger.info(f"Merging {len(input_files)} files into {output_file}")
         
-        # Create output file
-        output_driver = ogr.GetDriverByName("GPKG")
         if os.path.exists(output_file):
-            output_driver.DeleteDataSource(str(output_file))
-        
-        output_datasrc = output_driver.CreateDataSource(str(output_file))
+            os.remove(output_file)
         
-        for i, input_file in enumerate(input_files):
+        # Append all inputs into a single layer. The spatial index is left
+        # out while appending, and built once at the end.
+        num_merged = 0
+        for input_file in input_files:
             if os.path.exists(input_file):
-                input_datasrc = ogr.Open(str(input_file))
-                for layer_idx in range(input_datasrc.GetLayerCount()):
-                    input_layer = input_datasrc.GetLayerByIndex(layer_idx)
-                    layer_name = f"layer_{i}_{input_layer.GetName()}"
-                    output_layer = output_datasrc.CopyLayer(input_layer, layer_name)
-                    if output_layer is None:
-                        logger.warning(f"Failed to copy layer {input_layer.GetName()}")
+                gdal.VectorTranslate(
+                    str(output_file),
+                    str(input_file),
+                    options=gdal.VectorTranslateOptions(
+                        options=['-ds_transaction'],
+                        format='GPKG',
+                        accessMode='append' if num_merged > 0 else None,
+                        layerName=MERGED_LINES_LAYER,
+                        layerCreationOptions=['SPATIAL_INDEX=NO'],
+                    ),
+                )
+                num_merged += 1
+        
+        if num_merged > 0:
+            output_datasrc = ogr.Open(str(output_file), update=1)
+            output_layer = output_datasrc.GetLayerByName(MERGED_LINES_LAYER)
+            result = output_datasrc.ExecuteSQL(
+                f"SELECT CreateSpatialIndex('{MERGED_LINES_LAYER}', '{output_layer.GetGeometryColumn()}')"
+            )
+            output_datasrc.ReleaseResultSet(result)
+            output_datasrc = None
         
         logger.info("File merging complete")
     
+    @_with_gdal_config
     def burn_lines_to_raster(self, lines_file: Union[str, Path], output_raster: Union[str, Path]) -> None:
         """
         Burn 3D lines into the DTM raster.
@@ -366,28 +851,113 @@ class HydroAdjustWorkflow:
         """
         logger.info(f"Burning lines into DTM: {lines_file} -> {output_raster}")
         
-        input_raster_dataset = gdal.Open(str(self.dtm_raster))
-        lines_datasrc = ogr.Open(str(lines_file))
+        input_raster_dataset = self.dem_dataset
+        if input_raster_dataset.RasterCount != 1:
+            raise ValueError(
+                f"DTM raster must have a single band, not {input_raster_dataset.RasterCount}"
+            )
+        input_band = input_raster_dataset.GetRasterBand(1)
+        input_geotransform = input_raster_dataset.GetGeoTransform()
+        num_cols = input_raster_dataset.RasterXSize
+        num_rows = input_raster_dataset.RasterYSize
+        nodata_value = input_band.GetNoDataValue()
         
-        # Create intermediate in-memory dataset
-        intermediate_driver = gdal.GetDriverByName("MEM")
-        intermediate_raster_dataset = intermediate_driver.CreateCopy("temp", input_raster_dataset)
+        # Count the lines of all layers touching each block row, from
+        # their bounding boxes, so that block rows without any lines can be
+        # copied straight to the output
+        line_bounds = np.concatenate([
+            pyogrio.read_bounds(lines_file, layer=layer_name)[1].T
+            for layer_name in pyogrio.list_layers(lines_file)[:,0]
+        ])
+        block_row_line_count = _count_by_block_row(
+            line_bounds, input_geotransform, num_rows, BURN_BLOCK_SIZE
+        )
+        logger.info(f"Read {len(line_bounds)} lines to burn")
         
-        # Burn all layers
-        for layer in lines_datasrc:
-            burn_lines(intermediate_raster_dataset, layer)
-            logger.info(f"Burned layer {layer.GetName()}")
+        lines_datasrc = ogr.Open(str(lines_file))
         
-        # Save to output file
+        # Write straight to a tiled, compressed GeoTIFF. The floating point
+        # predictor only applies to floating point data.
+        if input_band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64):
+            predictor = '3'
+        else:
+            predictor = '2'
         output_driver = gdal.GetDriverByName("GTiff")
-        output_dataset = output_driver.CreateCopy(str(output_raster), intermediate_raster_dataset)
+        output_dataset = output_driver.Create(
+            str(output_raster),
+            num_cols,
+            num_rows,
+            1,
+            input_band.DataType,
+            options=GTIFF_CREATION_OPTIONS + [f'PREDICTOR={predictor}'],
+        )
+        output_dataset.SetGeoTransform(input_geotransform)
+        output_dataset.SetProjection(input_raster_dataset.GetProjection())
+        output_dataset.SetMetadata(input_raster_dataset.GetMetadata())
+        output_band = output_dataset.GetRasterBand(1)
+        if nodata_value is not None:
+            output_band.SetNoDataValue(nodata_value)
+        output_band.SetMetadata(input_band.GetMetadata())
+        output_band.SetDescription(input_band.GetDescription())
+        output_band.SetUnitType(input_band.GetUnitType())
+        if input_band.GetScale() is not None:
+            output_band.SetScale(input_band.GetScale())
+        if input_band.GetOffset() is not None:
+            output_band.SetOffset(input_band.GetOffset())
+        
+        # Process one row of output blocks at a time, so that only that
+        # strip of the DEM is held in memory
+        window_driver = gdal.GetDriverByName("MEM")
+        for block_row, row_off in enumerate(tqdm(range(0, num_rows, BURN_BLOCK_SIZE), desc="Burning lines")):
+            window_num_rows = min(BURN_BLOCK_SIZE, num_rows - row_off)
+            window_grid = input_band.ReadAsArray(0, row_off, num_cols, window_num_rows)
+            
+            if block_row_line_count[block_row] > 0:
+                window_geotransform = list(input_geotransform)
+                window_geotransform[3] = input_geotransform[3] + row_off * input_geotransform[5]
+                
+                window_dataset = window_driver.Create(
+                    "window", num_cols, window_num_rows, 1, input_band.DataType
+                )
+                window_dataset.SetGeoTransform(window_geotransform)
+                window_dataset.SetProjection(input_raster_dataset.GetProjection())
+                window_band = window_dataset.GetRasterBand(1)
+                if nodata_value is not None:
+                    window_band.SetNoDataValue(nodata_value)
+                window_band.WriteArray(window_grid)
+                
+                # Only burn lines near this window (padded by a pixel, as
+                # lines are burned with ALL_TOUCHED). The spatial filter
+                # uses the spatial index of the lines file.
+                window_x = (
+                    window_geotransform[0] - window_geotransform[1],
+                    window_geotransform[0] + (num_cols + 1) * window_geotransform[1],
+                )
+                window_y = (
+                    window_geotransform[3] - window_geotransform[5],
+                    window_geotransform[3] + (window_num_rows + 1) * window_geotransform[5],
+                )
+                for layer in lines_datasrc:
+                    layer.SetSpatialFilterRect(min(window_x), min(window_y), max(window_x), max(window_y))
+                    burn_lines(window_dataset, layer)
+                    layer.SetSpatialFilter(None)
+                
+                window_grid = window_band.ReadAsArray()
+                window_dataset = None
+            
+            output_band.WriteArray(window_grid, 0, row_off)
+        
+        lines_datasrc = None
+        output_dataset.FlushCache()
+        output_dataset = None
         
         logger.info("Line burning complete")
     
     def run_complete_workflow(self, 
                              horseshoe_layer: str = 'dhmhestesko',
                              line_layer: str = 'dhmlinje',
-                             max_sample_dist: Optional[float] = None) -> Path:
+                             max_sample_dist: Optional[float] = None,
+                             n_jobs: Optional[int] = 1) -> Path:
         """
         Run the complete hydro adjustment workflow.
         
@@ -399,6 +969,9 @@ class HydroAdjustWorkflow:
             Layer name for line data
         max_sample_dist : float, optional
             Maximum sampling distance for horseshoe profiles
+        n_jobs : int, optional
+            Number of processes for horseshoe sampling, or None for the number
+            of CPUs (defaults to 1)
             
         Returns:
         --------
@@ -417,7 +990,7 @@ class HydroAdjustWorkflow:
             
             # Step 3: Sample elevations for horseshoes (if filtered file exists)
             if os.path.exists(self.hs_filtered):
-                self.sample_horseshoe_z_lines(self.hs_filtered, self.hs_with_z, max_sample_dist)
+                self.sample_horseshoe_z_lines(self.hs_filtered, self.hs_with_z, max_sample_dist, n_jobs)
             
             # Step 4: Merge line files
             input_files = []
@@ -441,6 +1014,8 @@ class HydroAdjustWorkflow:
         except Exception as e:
             logger.error(f"Workflow failed: {e}")
             raise
+        finally:
+            self.close()
 
 
 # Convenience functions for direct notebook use
@@ -450,7 +1025,8 @@ def create_hydro_adjusted_dtm(dtm_raster: Union[str, Path],
                              output_dir: Union[str, Path],
                              horseshoe_layer: str = 'dhmhestesko',
                              line_layer: str = 'dhmlinje',
-                             max_sample_dist: Optional[float] = None) -> Path:
+                             max_sample_dist: Optional[float] = None,
+                             n_jobs: Optional[int] = 1) -> Path:
     """
     Convenience function to run the complete workflow in one call.
     
@@ -470,11 +1046,14 @@ def create_hydro_adjusted_dtm(dtm_raster: Union[str, Path],
         Layer name for line data
     max_sample_dist : float, optional
         Maximum sampling distance for horseshoe profiles
+    n_jobs : int, optional
+        Number of processes for horseshoe sampling, or None for the number of
+        CPUs (defaults to 1)
         
     Returns:
     --------
     Path
         Path to hydro-adjusted DTM
     """
-    workflow = HydroAdjustWorkflow(dtm_raster, horseshoe_file, line_file, output_dir)
-    return workflow.run_complete_workflow(horseshoe_layer, line_layer, max_sample_dist)
+    with HydroAdjustWorkflow(dtm_raster, horseshoe_file, line_file, output_dir) as workflow:
+        return workflow.run_complete_workflow(horseshoe_layer, line_layer, max_sample_dist, n_jobs)
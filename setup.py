@@ -17,13 +17,14 @@ setup(
     install_requires=[
         "gdal",
         "numpy",
-        "scipy",
         "tqdm",
         "geopandas",
+        "pyogrio",
         "shapely",
     ],
     extras_require={
         "dev": ["pytest"],
+        "numba": ["numba"],
     },
     entry_points={
         "console_scripts": [
@@ -31,7 +31,6 @@ def test_imports():
     
     try:
         import numpy as np
-        import scipy
         import tqdm
         import geopandas as gpd
         import shapely
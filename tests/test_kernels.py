@@ -0,0 +1,56 @@
+from hydroadjust._kernels import interpolate_bilinear, _interpolate_bilinear_numpy
+
+import numpy as np
+import pytest
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# interpolate_bilinear only runs the compiled kernel if Numba is available,
+# otherwise it would just test the NumPy fallback twice
+KERNELS = [
+    pytest.param(
+        interpolate_bilinear,
+        marks=pytest.mark.skipif(numba is None, reason="Numba is not installed"),
+        id="numba",
+    ),
+    pytest.param(_interpolate_bilinear_numpy, id="numpy"),
+]
+
+
+@pytest.mark.parametrize("kernel", KERNELS)
+def test_interpolate_bilinear(kernel):
+    # Tests bilinear interpolation at fractional indices, including points
+    # exactly on the outermost cell centers, points outside of the grid and
+    # NaN propagation from NODATA cells. Checked for the compiled kernel and
+    # the NumPy fallback alike.
+
+    z_grid = np.arange(12, dtype=np.float32).reshape(3, 4)
+    z_grid[2, 3] = np.nan
+
+    rows = np.array([0.0, 0.5, 0.75, 2.0, 0.0, -0.01, 0.0, 1.5, np.nan])
+    cols = np.array([0.0, 0.5, 2.25, 0.0, 3.0, 0.0, 3.01, 2.5, 0.0])
+    expected_z = np.array([0.0, 2.5, 5.25, 8.0, 3.0, np.nan, np.nan, np.nan, np.nan])
+
+    z = np.empty(len(rows), dtype=np.float32)
+    kernel(z_grid, rows, cols, z)
+
+    np.testing.assert_allclose(z, expected_z)
+
+
+@pytest.mark.parametrize("kernel", KERNELS)
+def test_interpolate_bilinear_single_row(kernel):
+    # A grid of a single row can only be interpolated along that row
+
+    z_grid = np.array([[1.0, 3.0]], dtype=np.float32)
+
+    rows = np.array([0.0, 0.0, 0.5])
+    cols = np.array([0.0, 0.5, 0.5])
+    expected_z = np.array([1.0, 2.0, np.nan])
+
+    z = np.empty(len(rows), dtype=np.float32)
+    kernel(z_grid, rows, cols, z)
+
+    np.testing.assert_allclose(z, expected_z)
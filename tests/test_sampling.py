@@ -1,4 +1,12 @@
-from hydroadjust.sampling import BoundingBox, get_raster_window, get_raster_interpolator
+from hydroadjust.sampling import (
+    BoundingBox,
+    get_raster_window,
+    get_raster_interpolator,
+    sample_raster_array,
+    sample_raster,
+    get_horseshoe_profiles,
+    TileCache,
+)
 
 from osgeo import gdal, osr
 import numpy as np
@@ -69,9 +77,10 @@ def test_raster_window():
 
 
 def test_raster_interpolator():
-    # Tests that the RegularGridInterpolator is correctly aligned and returns
+    # Tests that the raster interpolator is correctly aligned and returns
     # the expected data. This includes checking NODATA/NaN handling and
-    # feeding it scalars, 1D and 2D arrays of X and Y input.
+    # feeding it scalars, 1D and 2D arrays of X and Y input, given either as
+    # an (x, y) tuple or stacked along the last axis.
     
     input_grid = np.arange(12.0).reshape(3, 4)
     input_num_rows, input_num_cols = input_grid.shape
@@ -122,7 +131,7 @@ def test_raster_interpolator():
     input_band.SetNoDataValue(input_nodata_value)
     input_band.WriteArray(input_grid)
     
-    # Create the RegularGridInterpolator
+    # Create the interpolator
     interpolator = get_raster_interpolator(input_dataset)
     
     # Get the results with X and Y being scalars, lists and grids, respectively
@@ -130,7 +139,216 @@ def test_raster_interpolator():
     interp_list_z = interpolator((interp_list_x, interp_list_y))
     interp_grid_z = interpolator((interp_grid_x, interp_grid_y))
     
+    # The same points stacked along the last axis. Two points make a 2x2
+    # array, which must not be mistaken for an (x, y) pair.
+    stacked_point_z = interpolator(np.array([interp_point_x, interp_point_y]))
+    stacked_list_z = interpolator(np.column_stack([interp_list_x, interp_list_y]))
+    stacked_pair_z = interpolator(np.column_stack([interp_list_x[:2], interp_list_y[:2]]))
+    stacked_grid_z = interpolator(np.stack([interp_grid_x, interp_grid_y], axis=-1))
+    
     # Check results
     np.testing.assert_allclose(interp_point_z, expected_point_z)
     np.testing.assert_allclose(interp_list_z, expected_list_z)
     np.testing.assert_allclose(interp_grid_z, expected_grid_z)
+    np.testing.assert_allclose(stacked_point_z, expected_point_z)
+    np.testing.assert_allclose(stacked_list_z, expected_list_z)
+    np.testing.assert_allclose(stacked_pair_z, expected_list_z[:2])
+    np.testing.assert_allclose(stacked_grid_z, expected_grid_z)
+
+
+def test_sample_raster_array():
+    # Tests that batched sampling of a raster grid agrees with the
+    # interpolator-based sampling, including NaN outside the
+    # defined area and around NODATA cells.
+
+    input_grid = np.arange(12.0).reshape(3, 4)
+    input_geotransform = [600000.0, 0.5, 0.0, 6200000.0, 0.0, -0.5]
+
+    interp_grid_x, interp_grid_y = np.meshgrid(
+        600000.0 + np.array([1.25, 1.5, 1.75, 2.0, 2.25]),
+        6200000.0 - np.array([0.25, 0.375, 0.5, 0.625, 0.75]),
+    )
+    expected_grid_z = np.array([
+        [2.0, 2.5, 3.0, np.nan, np.nan],
+        [3.0, 3.5, 4.0, np.nan, np.nan],
+        [4.0, 4.5, 5.0, np.nan, np.nan],
+        [5.0, 5.5, 6.0, np.nan, np.nan],
+        [6.0, 6.5, 7.0, np.nan, np.nan],
+    ])
+
+    interp_grid_z = sample_raster_array(input_grid, input_geotransform, interp_grid_x, interp_grid_y)
+    np.testing.assert_allclose(interp_grid_z, expected_grid_z)
+
+    # Scalar input yields scalar-shaped output
+    interp_point_z = sample_raster_array(input_grid, input_geotransform, 600001.5, 6199999.5)
+    np.testing.assert_allclose(interp_point_z, 4.5)
+
+    # NaN (NODATA) cells must contaminate the surrounding interpolation
+    input_grid[1, 1] = np.nan
+    nodata_z = sample_raster_array(input_grid, input_geotransform, 600000.5, 6199999.5)
+    assert np.isnan(nodata_z)
+
+
+def test_horseshoe_profiles():
+    # Tests that profile sample locations are spread evenly along AD and BC,
+    # with the sample count determined by the longest profile of each
+    # horseshoe.
+
+    horseshoe_xy = np.array([
+        # Open profile AD of length 2, closed profile BC of length 1
+        [[0.0, 0.0], [0.5, 1.0], [1.5, 1.0], [2.0, 0.0]],
+        # Degenerate horseshoe, must still get 2 samples
+        [[5.0, 5.0], [5.0, 5.0], [5.0, 5.0], [5.0, 5.0]],
+    ])
+
+    feature_index, open_profile_xy, closed_profile_xy = get_horseshoe_profiles(horseshoe_xy, 0.5)
+
+    expected_feature_index = np.array([0, 0, 0, 0, 0, 1, 1])
+    expected_open_profile_xy = np.array([
+        [0.0, 0.0], [0.5, 0.0], [1.0, 0.0], [1.5, 0.0], [2.0, 0.0],
+        [5.0, 5.0], [5.0, 5.0],
+    ])
+    expected_closed_profile_xy = np.array([
+        [0.5, 1.0], [0.75, 1.0], [1.0, 1.0], [1.25, 1.0], [1.5, 1.0],
+        [5.0, 5.0], [5.0, 5.0],
+    ])
+
+    np.testing.assert_array_equal(feature_index, expected_feature_index)
+    np.testing.assert_allclose(open_profile_xy, expected_open_profile_xy)
+    np.testing.assert_allclose(closed_profile_xy, expected_closed_profile_xy)
+
+
+def _create_tiled_raster(name, grid, geotransform, nodata_value):
+    # Helper creating a small tiled GeoTIFF in GDAL's virtual filesystem, so
+    # that the raster consists of several blocks
+    dataset = gdal.GetDriverByName("GTiff").Create(
+        name,
+        grid.shape[1],
+        grid.shape[0],
+        1,
+        gdal.GDT_Float32,
+        options=["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"],
+    )
+    dataset.SetProjection("EPSG:25832")
+    dataset.SetGeoTransform(geotransform)
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata_value)
+    band.WriteArray(grid)
+    return dataset
+
+
+def test_tile_cache_window():
+    # Tests that windows assembled from cached blocks match the windows
+    # extracted with get_raster_window(), with NaN for NODATA and for areas
+    # outside of the source raster.
+
+    input_nodata_value = -1337
+    input_grid = np.arange(30.0).reshape(6, 5)
+    input_grid[3, 2] = input_nodata_value
+    input_geotransform = [600000.0, 0.1, 0.0, 6200000.0, 0.0, -0.1]
+
+    bbox = BoundingBox(
+        x_min=600000.21,
+        x_max=600000.42,
+        y_min=6199999.61,
+        y_max=6199999.79,
+    )
+
+    expected_grid = np.array([
+        [6., 7., 8., 9., np.nan],
+        [11., 12., 13., 14., np.nan],
+        [16., np.nan, 18., 19., np.nan],
+        [21., 22., 23., 24., np.nan],
+    ])
+    expected_geotransform = [600000.1, 0.1, 0.0, 6199999.9, 0.0, -0.1]
+
+    input_driver = gdal.GetDriverByName("MEM")
+    input_dataset = input_driver.Create("temp_input", 5, 6, 1, gdal.GDT_Float32)
+    input_dataset.SetProjection("EPSG:25832")
+    input_dataset.SetGeoTransform(input_geotransform)
+    input_band = input_dataset.GetRasterBand(1)
+    input_band.SetNoDataValue(input_nodata_value)
+    input_band.WriteArray(input_grid)
+
+    output_grid, output_geotransform = TileCache(input_dataset).get_window(bbox)
+
+    np.testing.assert_allclose(output_grid, expected_grid)
+    np.testing.assert_allclose(output_geotransform, expected_geotransform)
+
+
+def test_tile_cache_window_sampling():
+    # Tests that sampling windows from the TileCache (as the CLI tools do)
+    # gives the same result as sampling the entire grid at once, also when
+    # windows straddle block boundaries and blocks get evicted from the cache.
+
+    input_nodata_value = -9999
+    input_grid = np.arange(40.0*37.0).reshape(40, 37)
+    input_grid[20, 20] = input_nodata_value
+    input_geotransform = [600000.0, 0.5, 0.0, 6200000.0, 0.0, -0.5]
+    input_dataset = _create_tiled_raster(
+        "/vsimem/test_tile_cache_window_sampling.tif",
+        input_grid,
+        input_geotransform,
+        input_nodata_value,
+    )
+
+    reference_grid = input_grid.copy()
+    reference_grid[reference_grid == input_nodata_value] = np.nan
+
+    tile_cache = TileCache(input_dataset, max_tiles=2)
+
+    # Small objects across the entire raster and a bit beyond
+    random_generator = np.random.default_rng(42)
+    for _ in range(50):
+        interp_x = 600000.0 + random_generator.uniform(-1.0, 19.5) + random_generator.uniform(0.0, 3.0, 4)
+        interp_y = 6200000.0 - random_generator.uniform(-1.0, 21.0) - random_generator.uniform(0.0, 3.0, 4)
+        bbox = BoundingBox(
+            x_min=np.min(interp_x),
+            x_max=np.max(interp_x),
+            y_min=np.min(interp_y),
+            y_max=np.max(interp_y),
+        )
+
+        window_grid, window_geotransform = tile_cache.get_window(bbox)
+        interp_z = sample_raster_array(window_grid, window_geotransform, interp_x, interp_y)
+        expected_z = sample_raster_array(reference_grid, input_geotransform, interp_x, interp_y)
+
+        np.testing.assert_allclose(interp_z, expected_z, rtol=1e-6)
+
+    input_dataset = None
+    gdal.Unlink("/vsimem/test_tile_cache_window_sampling.tif")
+
+
+def test_sample_raster():
+    # Tests that block-wise sampling through the TileCache gives the same
+    # result as sampling the entire grid at once, also when points straddle
+    # block boundaries and blocks get evicted from the cache.
+
+    input_nodata_value = -9999
+    input_grid = np.arange(40.0*37.0).reshape(40, 37)
+    input_grid[20, 20] = input_nodata_value
+    input_geotransform = [600000.0, 0.5, 0.0, 6200000.0, 0.0, -0.5]
+    input_dataset = _create_tiled_raster(
+        "/vsimem/test_sample_raster.tif",
+        input_grid,
+        input_geotransform,
+        input_nodata_value,
+    )
+
+    # Points across the entire raster and a bit beyond
+    random_generator = np.random.default_rng(42)
+    interp_x = 600000.0 + random_generator.uniform(-1.0, 19.5, 500)
+    interp_y = 6200000.0 - random_generator.uniform(-1.0, 21.0, 500)
+
+    reference_grid = input_grid.copy()
+    reference_grid[reference_grid == input_nodata_value] = np.nan
+    expected_z = sample_raster_array(reference_grid, input_geotransform, interp_x, interp_y)
+
+    tile_cache = TileCache(input_dataset, max_tiles=2)
+    interp_z = sample_raster(tile_cache, interp_x, interp_y)
+
+    np.testing.assert_allclose(interp_z, expected_z, rtol=1e-6)
+    assert np.any(np.isnan(interp_z)) and np.any(np.isfinite(interp_z))
+
+    input_dataset = None
+    gdal.Unlink("/vsimem/test_sample_raster.tif")
@@ -0,0 +1,522 @@
+from hydroadjust import workflow as workflow_module
+from hydroadjust.workflow import (
+    HydroAdjustWorkflow, BURN_BLOCK_SIZE, GDAL_CACHE_MAX, GDAL_CONFIG_OPTIONS, MERGED_LINES_LAYER,
+    _count_by_block_row, _write_lines_with_z,
+)
+from hydroadjust.sampling import get_raster_interpolator, get_horseshoe_profiles
+from hydroadjust.burning import burn_lines
+
+from osgeo import gdal, ogr, osr
+import numpy as np
+import pyogrio
+import shapely
+import os
+import sqlite3
+import pytest
+
+
+def _create_dtm(path, grid, geotransform, nodata_value=None):
+    # Write a grid to a GeoTIFF DTM
+    num_rows, num_cols = grid.shape
+    dataset = gdal.GetDriverByName("GTiff").Create(
+        str(path), num_cols, num_rows, 1, gdal.GDT_Float32,
+    )
+    dataset.SetProjection("EPSG:25832")
+    dataset.SetGeoTransform(geotransform)
+    band = dataset.GetRasterBand(1)
+    if nodata_value is not None:
+        band.SetNoDataValue(nodata_value)
+    band.WriteArray(grid)
+    dataset = None
+
+
+def _create_lines(path, lines_xyz):
+    # Write 3D line segments to a GeoPackage
+    lines_srs = osr.SpatialReference()
+    lines_srs.ImportFromEPSG(25832)
+    lines_datasrc = ogr.GetDriverByName("GPKG").CreateDataSource(str(path))
+    lines_layer = lines_datasrc.CreateLayer(
+        "lines",
+        srs=lines_srs,
+        geom_type=ogr.wkbLineString25D,
+    )
+    for line_xyz in lines_xyz:
+        line_geometry = ogr.Geometry(ogr.wkbLineString25D)
+        for x, y, z in line_xyz:
+            line_geometry.AddPoint(x, y, z)
+        line_feature = ogr.Feature(lines_layer.GetLayerDefn())
+        line_feature.SetGeometry(line_geometry)
+        lines_layer.CreateFeature(line_feature)
+        line_feature = None
+    lines_datasrc = None
+
+
+def _create_linestrings(path, layer_name, lines_xy):
+    # Write 2D linestrings to a GeoPackage layer
+    lines_srs = osr.SpatialReference()
+    lines_srs.ImportFromEPSG(25832)
+    lines_datasrc = ogr.GetDriverByName("GPKG").CreateDataSource(str(path))
+    lines_layer = lines_datasrc.CreateLayer(
+        layer_name,
+        srs=lines_srs,
+        geom_type=ogr.wkbLineString,
+    )
+    for line_xy in lines_xy:
+        line_geometry = ogr.Geometry(ogr.wkbLineString)
+        for x, y in line_xy:
+            line_geometry.AddPoint_2D(x, y)
+        line_feature = ogr.Feature(lines_layer.GetLayerDefn())
+        line_feature.SetGeometry(line_geometry)
+        lines_layer.CreateFeature(line_feature)
+        line_feature = None
+    lines_datasrc = None
+
+
+def test_count_by_block_row():
+    # Tests that bounding boxes are counted in every block row they touch
+    # (padded by a pixel), including boxes straddling block row boundaries,
+    # and that boxes outside the raster or with NaN bounds are left out.
+
+    # 25 rows in block rows of 10 rows: 0-9, 10-19 and 20-24 (partial)
+    geotransform = [0.0, 1.0, 0.0, 100.0, 0.0, -1.0]
+    bounds = np.array([
+        [1.0, 95.0, 2.0, 97.0],   # rows 3-5: block row 0
+        [1.0, 88.5, 2.0, 91.5],   # rows 8-11: block rows 0 and 1
+        [1.0, -50.0, 2.0, -40.0], # below the raster
+        [np.nan, np.nan, np.nan, np.nan], # empty geometry
+        [1.0, 70.0, 2.0, 80.0],   # rows 20-30, padded to 19-31: block rows 1 and 2
+        [1.0, 105.0, 2.0, 110.0], # above the raster
+    ])
+
+    np.testing.assert_array_equal(_count_by_block_row(bounds, geotransform, 25, 10), [2, 2, 1])
+
+    # Rows increasing with Y (positive pixel height)
+    geotransform = [0.0, 1.0, 0.0, 0.0, 0.0, 1.0]
+    bounds = np.array([
+        [1.0, 8.5, 2.0, 11.5],    # rows 8-11: block rows 0 and 1
+        [1.0, 3.0, 2.0, 5.0],     # rows 3-5: block row 0
+    ])
+
+    np.testing.assert_array_equal(_count_by_block_row(bounds, geotransform, 25, 10), [2, 1, 0])
+
+    # No geometries at all
+    np.testing.assert_array_equal(_count_by_block_row(np.empty((0, 4)), geotransform, 25, 10), [0, 0, 0])
+
+
+def test_burn_lines_to_raster(tmp_path):
+    # Tests that burning block row by block row gives the same result as
+    # burning the whole raster at once, in particular for lines crossing the
+    # boundary between two block rows and lines partly or fully outside the
+    # raster, and that the raster and band metadata are kept.
+
+    num_rows = 2*BURN_BLOCK_SIZE + 50
+    num_cols = 10
+    geotransform = [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0]
+    grid = np.arange(num_rows*num_cols, dtype=np.float32).reshape(num_rows, num_cols)
+    grid[BURN_BLOCK_SIZE, 0] = -9999.0 # NODATA
+    boundary_y = geotransform[3] - BURN_BLOCK_SIZE
+
+    lines_xyz = [
+        # Diagonal across the first block row boundary, sloping in Z
+        [(600000.5, boundary_y + 5.5, 10.0), (600009.5, boundary_y - 5.5, 20.0)],
+        # Inside the last (partial) block row only
+        [(600002.5, 6199440.5, 40.0), (600006.5, 6199480.5, 50.0)],
+        # Partly outside the raster
+        [(599995.5, 6199990.5, 60.0), (600003.5, 6199990.5, 60.0)],
+        # Entirely outside the raster
+        [(601000.5, 6199990.5, 70.0), (601005.5, 6199995.5, 70.0)],
+    ]
+
+    dtm_path = tmp_path / "dtm.tif"
+    lines_path = tmp_path / "lines.gpkg"
+    output_path = tmp_path / "burned.tif"
+    _create_dtm(dtm_path, grid, geotransform, nodata_value=-9999.0)
+    _create_lines(lines_path, lines_xyz)
+
+    dtm_dataset = gdal.Open(str(dtm_path), gdal.GA_Update)
+    dtm_dataset.SetMetadataItem("AREA_OR_POINT", "Point")
+    dtm_band = dtm_dataset.GetRasterBand(1)
+    dtm_band.SetDescription("elevation")
+    dtm_band.SetMetadataItem("SOURCE", "test")
+    dtm_band.SetUnitType("m")
+    dtm_band.SetScale(0.5)
+    dtm_band.SetOffset(100.0)
+    dtm_band = None
+    dtm_dataset = None
+
+    # Expected output, burning the lines into a copy of the whole DTM
+    dtm_dataset = gdal.Open(str(dtm_path))
+    expected_dataset = gdal.GetDriverByName("MEM").CreateCopy("expected", dtm_dataset)
+    dtm_dataset = None
+    lines_datasrc = ogr.Open(str(lines_path))
+    burn_lines(expected_dataset, lines_datasrc.GetLayer())
+    lines_datasrc = None
+    expected_grid = expected_dataset.GetRasterBand(1).ReadAsArray()
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "output") as workflow:
+        workflow.burn_lines_to_raster(lines_path, output_path)
+
+    output_dataset = gdal.Open(str(output_path))
+    output_band = output_dataset.GetRasterBand(1)
+
+    # Sanity check that the line crossing the boundary is burned on both sides
+    assert np.any(expected_grid[BURN_BLOCK_SIZE - 1] != grid[BURN_BLOCK_SIZE - 1])
+    assert np.any(expected_grid[BURN_BLOCK_SIZE] != grid[BURN_BLOCK_SIZE])
+    np.testing.assert_allclose(output_band.ReadAsArray(), expected_grid)
+    assert output_band.GetNoDataValue() == -9999.0
+    assert output_dataset.GetGeoTransform() == tuple(geotransform)
+    assert output_dataset.GetMetadataItem("AREA_OR_POINT") == "Point"
+    assert output_band.GetDescription() == "elevation"
+    assert output_band.GetMetadataItem("SOURCE") == "test"
+    assert output_band.GetUnitType() == "m"
+    assert output_band.GetScale() == 0.5
+    assert output_band.GetOffset() == 100.0
+
+
+def test_burn_lines_to_raster_multiband(tmp_path):
+    # Tests that a DTM with more than one band is rejected
+
+    dtm_path = tmp_path / "dtm.tif"
+    output_path = tmp_path / "burned.tif"
+    dtm_dataset = gdal.GetDriverByName("GTiff").Create(str(dtm_path), 10, 10, 2, gdal.GDT_Float32)
+    dtm_dataset.SetGeoTransform([600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0])
+    dtm_dataset = None
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "output") as workflow:
+        with pytest.raises(ValueError):
+            workflow.burn_lines_to_raster("unused", output_path)
+    assert not output_path.exists()
+
+
+def test_dem_array(tmp_path, monkeypatch):
+    # Tests that the DTM array is decoded (with NODATA as NaN) on first use,
+    # reused by a later workflow on the same output directory, and decoded
+    # again once the DTM raster has changed.
+
+    write_count = [0]
+    write_dem_array = workflow_module._write_dem_array
+    def counting_write_dem_array(*args):
+        write_count[0] += 1
+        write_dem_array(*args)
+    monkeypatch.setattr(workflow_module, "_write_dem_array", counting_write_dem_array)
+
+    geotransform = [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0]
+    grid = np.arange(300.0, dtype=np.float32).reshape(20, 15)
+    grid[3, 4] = -9999.0
+    expected_grid = grid.copy()
+    expected_grid[3, 4] = np.nan
+
+    dtm_path = tmp_path / "dtm.tif"
+    output_dir = tmp_path / "output"
+    _create_dtm(dtm_path, grid, geotransform, nodata_value=-9999.0)
+
+    # Decoded on first use
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", output_dir) as workflow:
+        dem_array = workflow.dem_array
+        assert dem_array.dtype == np.float32
+        np.testing.assert_array_equal(dem_array, expected_grid)
+        del dem_array
+    assert write_count[0] == 1
+    assert workflow.dem_array_file.exists() and workflow.dem_array_metadata.exists()
+    assert not (output_dir / (workflow.dem_array_file.name + ".partial")).exists()
+
+    # Reused as long as the DTM is unchanged
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", output_dir) as workflow:
+        np.testing.assert_array_equal(workflow.dem_array, expected_grid)
+    assert write_count[0] == 1
+
+    # Decoded again after the DTM has been rewritten (with a later
+    # modification time, as it may only be resolved to the second)
+    _create_dtm(dtm_path, grid + 1.0, geotransform)
+    dtm_mtime = os.stat(dtm_path).st_mtime
+    os.utime(dtm_path, (dtm_mtime + 10.0, dtm_mtime + 10.0))
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", output_dir) as workflow:
+        np.testing.assert_array_equal(workflow.dem_array, grid + 1.0)
+    assert write_count[0] == 2
+
+
+def test_dem_tile_sampling(tmp_path):
+    # Tests that a DTM above the array size limit is sampled block by block,
+    # with the same result as sampling the DTM array and without decoding it
+    # to an array file.
+
+    geotransform = [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0]
+    grid = np.random.default_rng(0).uniform(0.0, 50.0, (40, 30)).astype(np.float32)
+    grid[10, 12] = -9999.0
+
+    dtm_path = tmp_path / "dtm.tif"
+    _create_dtm(dtm_path, grid, geotransform, nodata_value=-9999.0)
+
+    x = np.random.default_rng(1).uniform(599998.0, 600032.0, 1000)
+    y = np.random.default_rng(2).uniform(6199958.0, 6200002.0, 1000)
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "array") as workflow:
+        assert workflow.use_dem_array
+        expected_z = workflow._sample_dem(x, y)
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "tiles",
+                             dem_array_max_bytes=grid.nbytes - 1) as workflow:
+        assert not workflow.use_dem_array
+        z = workflow._sample_dem(x, y)
+    assert not workflow.dem_array_file.exists()
+
+    assert np.any(np.isnan(expected_z)) and np.any(np.isfinite(expected_z))
+    np.testing.assert_allclose(z, expected_z, rtol=1e-6)
+
+
+def test_sample_dem_parallel(tmp_path, monkeypatch):
+    # Tests that sampling in worker processes gives the same result as
+    # sampling in-process, both through the DTM array and block by block,
+    # and that n_jobs=0 is rejected.
+
+    monkeypatch.setattr(workflow_module, "PARALLEL_MIN_SAMPLES", 100)
+
+    geotransform = [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0]
+    grid = np.random.default_rng(0).uniform(0.0, 50.0, (40, 30)).astype(np.float32)
+    grid[10, 12] = -9999.0
+
+    dtm_path = tmp_path / "dtm.tif"
+    _create_dtm(dtm_path, grid, geotransform, nodata_value=-9999.0)
+
+    x = np.random.default_rng(1).uniform(599998.0, 600032.0, 1000)
+    y = np.random.default_rng(2).uniform(6199958.0, 6200002.0, 1000)
+
+    for dem_array_max_bytes in [None, 0]:
+        with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "output",
+                                 dem_array_max_bytes=dem_array_max_bytes) as workflow:
+            expected_z = workflow._sample_dem(x, y, n_jobs=1)
+            np.testing.assert_allclose(workflow._sample_dem(x, y, n_jobs=2), expected_z, rtol=1e-6)
+            np.testing.assert_allclose(workflow._sample_dem(x, y, n_jobs=-1), expected_z, rtol=1e-6)
+            with pytest.raises(ValueError):
+                workflow._sample_dem(x, y, n_jobs=0)
+
+
+def test_filter_vector_file(tmp_path):
+    # Tests that only the features intersecting the bounds are copied, and
+    # that no output is left behind when no features match or the layer
+    # does not exist.
+
+    lines_xyz = [
+        [(600001.0, 6199999.0, 0.0), (600005.0, 6199995.0, 0.0)],     # inside
+        [(599995.0, 6199990.0, 0.0), (600005.0, 6199990.0, 0.0)],     # crossing the bounds
+        [(601000.0, 6199990.0, 0.0), (601005.0, 6199995.0, 0.0)],     # outside
+    ]
+    bounds = (600000.0, 6199980.0, 600020.0, 6200000.0)
+
+    lines_path = tmp_path / "lines.gpkg"
+    output_path = tmp_path / "filtered.gpkg"
+    _create_lines(lines_path, lines_xyz)
+
+    assert HydroAdjustWorkflow._filter_vector_file(lines_path, "lines", output_path, bounds) == 2
+    assert len(pyogrio.read_dataframe(output_path, layer="lines")) == 2
+
+    # No features within the bounds, replacing the previous output
+    empty_bounds = (700000.0, 6199980.0, 700020.0, 6200000.0)
+    assert HydroAdjustWorkflow._filter_vector_file(lines_path, "lines", output_path, empty_bounds) == 0
+    assert not output_path.exists()
+
+    with pytest.raises(RuntimeError):
+        HydroAdjustWorkflow._filter_vector_file(lines_path, "missing", output_path, bounds)
+    assert not output_path.exists()
+
+
+def test_sample_horseshoe_z_lines(tmp_path):
+    # Tests that horseshoes are rendered as 3D lines between the samples of
+    # their open and closed profiles, that a horseshoe with any invalid
+    # sample is left out entirely, and that geometries without exactly 4
+    # points are skipped.
+
+    geotransform = [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0]
+    grid = np.random.default_rng(0).uniform(0.0, 50.0, (20, 20)).astype(np.float32)
+    grid[15, 5] = -9999.0 # NODATA, centered at (600005.5, 6199984.5)
+
+    horseshoes_xy = [
+        [(600002.5, 6199997.5), (600002.5, 6199992.5), (600008.5, 6199992.5), (600008.5, 6199997.5)],
+        # Open profile crossing the NODATA cell
+        [(600002.5, 6199984.5), (600002.5, 6199982.5), (600008.5, 6199982.5), (600008.5, 6199984.5)],
+        # Not a horseshoe
+        [(600002.5, 6199990.5), (600005.5, 6199990.5), (600008.5, 6199990.5)],
+        [(600012.5, 6199988.5), (600014.5, 6199990.5), (600017.0, 6199985.0), (600015.0, 6199983.0)],
+    ]
+
+    dtm_path = tmp_path / "dtm.tif"
+    horseshoes_path = tmp_path / "horseshoes.gpkg"
+    output_path = tmp_path / "horseshoe_lines.gpkg"
+    _create_dtm(dtm_path, grid, geotransform, nodata_value=-9999.0)
+    _create_linestrings(horseshoes_path, "horseshoes", horseshoes_xy)
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "output") as workflow:
+        workflow.sample_horseshoe_z_lines(horseshoes_path, output_path, max_sample_dist=1.0)
+
+    # Expected lines, from the horseshoes with 4 points
+    interpolator = get_raster_interpolator(gdal.Open(str(dtm_path)))
+    feature_index, open_profile_xy, closed_profile_xy = get_horseshoe_profiles(
+        np.array([horseshoes_xy[i] for i in [0, 1, 3]]), 1.0
+    )
+    open_profile_z = interpolator(open_profile_xy)
+    closed_profile_z = interpolator(closed_profile_xy)
+    assert np.any(np.isnan(open_profile_z[feature_index == 1]))
+    expected_lines_xyz = np.stack(
+        [
+            np.column_stack([open_profile_xy, open_profile_z]),
+            np.column_stack([closed_profile_xy, closed_profile_z]),
+        ],
+        axis=1,
+    )[feature_index != 1]
+
+    layers = pyogrio.list_layers(output_path)
+    assert layers.tolist() == [["horseshoe_lines_with_z", "LineString Z"]]
+    output_gdf = pyogrio.read_dataframe(output_path, layer="horseshoe_lines_with_z")
+    assert output_gdf.crs.to_epsg() == 25832
+    output_lines_xyz = shapely.get_coordinates(output_gdf.geometry, include_z=True).reshape(-1, 2, 3)
+    np.testing.assert_allclose(output_lines_xyz, expected_lines_xyz, rtol=1e-6)
+
+
+def test_sample_line_z(tmp_path):
+    # Tests that lines are rendered in 3D with Z sampled at their endpoints,
+    # that lines with an endpoint near NODATA or outside the raster (or
+    # without exactly 2 points) are left out, and that an input without any
+    # valid lines gives an empty layer, which can still be merged and burned.
+
+    geotransform = [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0]
+    grid = np.random.default_rng(0).uniform(0.0, 50.0, (20, 20)).astype(np.float32)
+    grid[15, 5] = -9999.0 # NODATA, centered at (600005.5, 6199984.5)
+
+    lines_xy = [
+        [(600002.5, 6199997.5), (600008.5, 6199992.5)],
+        # Endpoint at the NODATA cell
+        [(600002.5, 6199984.5), (600005.5, 6199984.5)],
+        # Endpoint outside the raster
+        [(600010.5, 6199990.5), (600030.0, 6199990.5)],
+        # Not a line segment
+        [(600012.5, 6199988.5), (600014.5, 6199983.0), (600015.0, 6199982.0)],
+        [(600001.0, 6199999.0), (600019.0, 6199981.0)],
+    ]
+
+    dtm_path = tmp_path / "dtm.tif"
+    lines_path = tmp_path / "lines.gpkg"
+    output_path = tmp_path / "lines_with_z.gpkg"
+    invalid_lines_path = tmp_path / "invalid_lines.gpkg"
+    empty_output_path = tmp_path / "empty_lines_with_z.gpkg"
+    merged_path = tmp_path / "merged.gpkg"
+    burned_path = tmp_path / "burned.tif"
+    _create_dtm(dtm_path, grid, geotransform, nodata_value=-9999.0)
+    _create_linestrings(lines_path, "lines", lines_xy)
+    _create_linestrings(invalid_lines_path, "lines", lines_xy[1:3])
+
+    with HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "output") as workflow:
+        workflow.sample_line_z(lines_path, output_path)
+        workflow.sample_line_z(invalid_lines_path, empty_output_path)
+        workflow.merge_line_files([empty_output_path], merged_path)
+        workflow.burn_lines_to_raster(merged_path, burned_path)
+
+    # Expected lines, from the valid line segments
+    interpolator = get_raster_interpolator(gdal.Open(str(dtm_path)))
+    expected_lines_xy = np.array([lines_xy[0], lines_xy[4]])
+    expected_lines_xyz = np.concatenate(
+        [expected_lines_xy, interpolator(expected_lines_xy)[:,:,np.newaxis]], axis=2
+    )
+    assert np.all(np.isnan(interpolator(np.array(lines_xy[1:3]))[:,1]))
+
+    assert pyogrio.list_layers(output_path).tolist() == [["lines_with_z", "LineString Z"]]
+    output_gdf = pyogrio.read_dataframe(output_path, layer="lines_with_z")
+    assert output_gdf.crs.to_epsg() == 25832
+    output_lines_xyz = shapely.get_coordinates(output_gdf.geometry, include_z=True).reshape(-1, 2, 3)
+    np.testing.assert_allclose(output_lines_xyz, expected_lines_xyz, rtol=1e-6)
+
+    assert pyogrio.list_layers(empty_output_path).tolist() == [["lines_with_z", "LineString Z"]]
+    assert len(pyogrio.read_dataframe(empty_output_path, layer="lines_with_z")) == 0
+    burned_grid = gdal.Open(str(burned_path)).GetRasterBand(1).ReadAsArray()
+    np.testing.assert_array_equal(burned_grid, grid)
+
+
+def test_write_lines_with_z(tmp_path):
+    # Tests that 3D line segments are written as a LineString Z layer with
+    # the given name and CRS, replacing any existing file.
+
+    lines_xyz = np.array([
+        [(600001.0, 6199999.0, 12.25), (600005.0, 6199995.0, 13.5)],
+        [(600010.0, 6199990.0, -1.0), (600010.0, 6199980.0, 0.0)],
+    ])
+    output_path = tmp_path / "lines_with_z.gpkg"
+
+    _write_lines_with_z(lines_xyz[::-1], "EPSG:25832", output_path, "old_lines")
+    _write_lines_with_z(lines_xyz, "EPSG:25832", output_path, "lines_with_z")
+
+    assert pyogrio.list_layers(output_path).tolist() == [["lines_with_z", "LineString Z"]]
+    output_gdf = pyogrio.read_dataframe(output_path, layer="lines_with_z")
+    assert output_gdf.crs.to_epsg() == 25832
+    np.testing.assert_array_equal(
+        shapely.get_coordinates(output_gdf.geometry, include_z=True).reshape(-1, 2, 3),
+        lines_xyz,
+    )
+
+
+def test_merge_line_files(tmp_path):
+    # Tests that the outputs of both samplers are merged into a single layer,
+    # lines first and then horseshoe lines, with a spatial index, and that
+    # missing inputs are skipped.
+
+    lines_xyz = np.array([
+        [(600001.0, 6199999.0, 12.0), (600005.0, 6199995.0, 13.0)],
+        [(600010.0, 6199990.0, 14.0), (600010.0, 6199980.0, 15.0)],
+    ])
+    horseshoe_lines_xyz = np.array([
+        [(600002.0, 6199997.0, 20.0), (600002.0, 6199992.0, 21.0)],
+        [(600003.0, 6199997.0, 22.0), (600003.0, 6199992.0, 23.0)],
+        [(600004.0, 6199997.0, 24.0), (600004.0, 6199992.0, 25.0)],
+    ])
+
+    lines_path = tmp_path / "lines_with_z.gpkg"
+    horseshoe_lines_path = tmp_path / "horseshoe_with_z.gpkg"
+    merged_path = tmp_path / "combined_lines.gpkg"
+    _write_lines_with_z(lines_xyz, "EPSG:25832", lines_path, "lines_with_z")
+    _write_lines_with_z(horseshoe_lines_xyz, "EPSG:25832", horseshoe_lines_path, "horseshoe_lines_with_z")
+
+    with HydroAdjustWorkflow("unused", "unused", "unused", tmp_path / "output") as workflow:
+        workflow.merge_line_files([lines_path, tmp_path / "missing.gpkg", horseshoe_lines_path], merged_path)
+
+    assert pyogrio.list_layers(merged_path).tolist() == [[MERGED_LINES_LAYER, "LineString Z"]]
+    merged_gdf = pyogrio.read_dataframe(merged_path, layer=MERGED_LINES_LAYER)
+    assert merged_gdf.crs.to_epsg() == 25832
+    np.testing.assert_array_equal(
+        shapely.get_coordinates(merged_gdf.geometry, include_z=True).reshape(-1, 2, 3),
+        np.concatenate([lines_xyz, horseshoe_lines_xyz]),
+    )
+
+    # The spatial index is registered, and its R-tree table holds all lines
+    connection = sqlite3.connect(str(merged_path))
+    (geometry_column,), = connection.execute(
+        "SELECT column_name FROM gpkg_extensions WHERE table_name = ? AND extension_name = 'gpkg_rtree_index'",
+        (MERGED_LINES_LAYER,),
+    ).fetchall()
+    (num_indexed,), = connection.execute(
+        f'SELECT COUNT(*) FROM "rtree_{MERGED_LINES_LAYER}_{geometry_column}"'
+    ).fetchall()
+    connection.close()
+    assert num_indexed == len(merged_gdf)
+
+
+def test_step_gdal_config(tmp_path, monkeypatch):
+    # Tests that a step applies the GDAL configuration while it runs, also
+    # when the workflow is not used as a context manager, and restores the
+    # previous configuration afterwards.
+
+    dtm_path = tmp_path / "dtm.tif"
+    _create_dtm(dtm_path, np.zeros((10, 10), dtype=np.float32), [600000.0, 1.0, 0.0, 6200000.0, 0.0, -1.0])
+
+    open_config = []
+    gdal_open = gdal.Open
+    def recording_open(*args):
+        open_config.append((gdal.GetConfigOption("GDAL_NUM_THREADS"), gdal.GetCacheMax()))
+        return gdal_open(*args)
+    monkeypatch.setattr(gdal, "Open", recording_open)
+
+    previous_config = (gdal.GetConfigOption("GDAL_NUM_THREADS"), gdal.GetCacheMax())
+    workflow = HydroAdjustWorkflow(dtm_path, "unused", "unused", tmp_path / "output")
+    workflow.get_raster_bounds()
+    workflow.close()
+
+    assert open_config == [(GDAL_CONFIG_OPTIONS["GDAL_NUM_THREADS"], GDAL_CACHE_MAX)]
+    assert (gdal.GetConfigOption("GDAL_NUM_THREADS"), gdal.GetCacheMax()) == previous_config